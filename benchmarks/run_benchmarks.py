@@ -0,0 +1,139 @@
+"""Timing and memory benchmarks for the core function of each command
+
+Usage: python benchmarks/run_benchmarks.py --num-loops 10000 --num-loops 100000 --num-intervals 100 --output-file bench.tsv
+
+Each benchmark is run once for timing and once more under tracemalloc for peak memory (which numpy reports to).
+Besides the synthetic scales, the example data (merged_5K_10K.loop against 95_BCS_psor_loci on hg19) is always run
+as a realistic baseline. The loops_exponent and intervals_exponent columns are the slopes of log(time) against
+log(number of loops) and log(number of intervals) since the previous scale, so ~1 means linear scaling.
+"""
+
+import contextlib
+import io
+import math
+import os
+import tempfile
+import time
+import tracemalloc
+
+import click
+import numpy as np
+import pandas as pd
+from synthetic import EXAMPLE_DATA, make_chr_rg, make_intervals, make_loops, write_table
+
+from loopsim import common
+from loopsim.analyze import IntervalsIndex, analyze_loop_file
+from loopsim.simulate import run_sim
+from loopsim.validate import validate_loop_in
+
+
+def measure(func):
+    """Run func and return (seconds, peak MB allocated)"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - start
+
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return seconds, peak / 2**20
+
+
+def bench_case(case, loop_file, chromosome_region_file, intervals_file):
+    """Benchmark run_sim, analyze_loop_file and validate_loop_in on one set of input files"""
+    loop_in = common.read_table(loop_file, "loop")
+    chr_rg = common.read_table(chromosome_region_file, "region")
+    intervals = common.read_table(intervals_file, "intervals")
+    scale = {"case": case, "num_loops": len(loop_in), "num_intervals": len(intervals)}
+
+    benchmarks = {
+        "run_sim": lambda: run_sim(loop_in, chr_rg, 0, seed=0),
+        "analyze_loop_file": lambda: analyze_loop_file(loop_file, [IntervalsIndex(intervals)], []),
+        "validate_loop_in": lambda: validate_loop_in(loop_in, 100_000),
+    }
+    results = []
+    for name, func in benchmarks.items():
+        seconds, peak_mb = measure(func)
+        results.append({"function": name, **scale, "seconds": seconds, "peak_mb": peak_mb})
+        print(f"{name:<18} {case:<10} loops={len(loop_in):<10} intervals={len(intervals):<8} {seconds:9.3f}s {peak_mb:9.1f}MB")
+    return results
+
+
+def add_scaling_exponents(results):
+    """Slope of log(seconds) against log(scale) between consecutive synthetic cases of the same function"""
+    synthetic_cases = results["case"] == "synthetic"
+    for axis, other, column in (
+        ("num_loops", "num_intervals", "loops_exponent"),
+        ("num_intervals", "num_loops", "intervals_exponent"),
+    ):
+        results[column] = math.nan
+        for _, group in results[synthetic_cases].groupby("function"):
+            for _, curve in group.groupby(other):
+                curve = curve.sort_values(axis)
+                if len(curve) < 2 or curve[axis].nunique() < 2:
+                    continue
+                slopes = np.log(curve["seconds"].to_numpy()[1:] / curve["seconds"].to_numpy()[:-1]) / np.log(
+                    curve[axis].to_numpy()[1:] / curve[axis].to_numpy()[:-1]
+                )
+                results.loc[curve.index[1:], column] = slopes
+    return results
+
+
+@click.command()
+@click.option(
+    "--num-loops",
+    multiple=True,
+    type=int,
+    default=[10_000, 100_000, 1_000_000],
+    show_default=True,
+    help="synthetic loop file sizes (repeat for several)",
+)
+@click.option(
+    "--num-intervals",
+    multiple=True,
+    type=int,
+    default=[100, 10_000],
+    show_default=True,
+    help="synthetic intervals file sizes (repeat for several)",
+)
+@click.option("--seed", show_default=True, default=0, type=int, help="random seed for the synthetic data")
+@click.option(
+    "--output-file",
+    type=click.Path(exists=False, file_okay=True, dir_okay=False, writable=True),
+    help="if passed, will output the results as a table to this file",
+)
+def run_benchmarks(num_loops, num_intervals, seed, output_file):
+    """Benchmark every command's core function on the example data and on synthetic data of increasing size"""
+    results = bench_case(
+        "example",
+        os.path.join(EXAMPLE_DATA, "merged_5K_10K.loop"),
+        os.path.join(EXAMPLE_DATA, "chr_region_hg19"),
+        os.path.join(EXAMPLE_DATA, "95_BCS_psor_loci"),
+    )
+
+    rng = np.random.default_rng(seed)
+    chr_rg = make_chr_rg()
+    with tempfile.TemporaryDirectory() as data_dir:
+        chromosome_region_file = os.path.join(data_dir, "chr_region")
+        write_table(chr_rg, chromosome_region_file)
+        for n_intervals in sorted(num_intervals):
+            intervals_file = os.path.join(data_dir, f"intervals_{n_intervals}")
+            write_table(make_intervals(n_intervals, chr_rg, rng), intervals_file)
+            for n_loops in sorted(num_loops):
+                loop_file = os.path.join(data_dir, f"loops_{n_loops}.loop")
+                if not os.path.isfile(loop_file):
+                    write_table(make_loops(n_loops, chr_rg, rng), loop_file)
+                results += bench_case("synthetic", loop_file, chromosome_region_file, intervals_file)
+
+    results = add_scaling_exponents(pd.DataFrame(results))
+    print()
+    print(results.sort_values(by=["function", "case", "num_intervals", "num_loops"]).to_string(index=False))
+    if output_file:
+        results.to_csv(output_file, index=None, sep="\t")
+        print(f"Outputted benchmark results to {output_file}")
+
+
+if __name__ == "__main__":
+    run_benchmarks()
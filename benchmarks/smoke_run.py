@@ -0,0 +1,144 @@
+"""Smoke run of every loopsim command on the example data
+
+Usage: python benchmarks/smoke_run.py --num-sims 4 --num-processes 2
+
+Each command is run once, in a fresh interpreter and with --metrics-file, on a few simulations of the example data
+(merged_5K_10K.loop against 95_BCS_psor_loci on hg19), covering text and binary store simulations, sharded
+sim-analyze runs and their merge. The run fails if any command exits with an error, if the metrics file is not valid
+JSON lines, or if a command did not record its totals.
+
+The example loop file is also analyzed with its rows shuffled (so its chromosomes are not grouped together), by analyze
+and by batch-analyze --loop-out-directory, and every loop must get the same overlaps as in the original file.
+"""
+
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+
+import click
+from synthetic import EXAMPLE_DATA
+
+LOOP_FILE = os.path.join(EXAMPLE_DATA, "merged_5K_10K.loop")
+CHROMOSOME_REGION_FILE = os.path.join(EXAMPLE_DATA, "chr_region_hg19")
+INTERVALS_FILE = os.path.join(EXAMPLE_DATA, "95_BCS_psor_loci")
+
+
+def smoke_commands(directory, num_sims, num_processes):
+    """Arguments of each command to run, in order (later commands read the outputs of earlier ones)"""
+    path = lambda *names: os.path.join(directory, *names)  # noqa: E731
+    sims = ["--num-sims", str(num_sims), "--num-processes", str(num_processes), "--seed", "0"]
+    return [
+        ["validate", LOOP_FILE, path("validated.loop"), CHROMOSOME_REGION_FILE],
+        ["simulate", *sims, path("validated.loop"), CHROMOSOME_REGION_FILE, path("text_sims")],
+        ["simulate", *sims, "--output-format", "npy", path("validated.loop"), CHROMOSOME_REGION_FILE, path("store_sims")],
+        ["analyze", path("validated.loop"), path("analyzed.loop"), INTERVALS_FILE],
+        ["analyze", "--sim-index", "1", path("store_sims", "sim_hi-c.npy"), path("analyzed_sim.loop"), INTERVALS_FILE],
+        ["batch-analyze", "--num-processes", str(num_processes), path("text_sims"), INTERVALS_FILE, path("text_ratios.txt")],
+        ["batch-analyze", "--num-processes", str(num_processes), path("store_sims"), INTERVALS_FILE, path("store_ratios.txt")],
+        *(
+            [
+                "sim-analyze",
+                *sims,
+                "--shard-index",
+                str(shard),
+                "--shard-count",
+                "2",
+                path("validated.loop"),
+                CHROMOSOME_REGION_FILE,
+                INTERVALS_FILE,
+                path(f"shard_{shard}.txt"),
+            ]
+            for shard in range(2)
+        ),
+        ["merge", path("shard_0.txt"), path("shard_1.txt"), path("merged_ratios.txt")],
+        ["analyze", LOOP_FILE, path("analyzed_example.loop"), INTERVALS_FILE],
+        ["analyze", path("shuffled", "shuffled.loop"), path("analyzed_shuffled.loop"), INTERVALS_FILE],
+        [
+            "batch-analyze",
+            "--num-processes",
+            str(num_processes),
+            "--loop-out-directory",
+            path("batch_analyzed_shuffled"),
+            path("shuffled"),
+            INTERVALS_FILE,
+            path("shuffled_ratios.txt"),
+        ],
+    ]
+
+
+def write_shuffled(loop_file, shuffled_file):
+    """Copy of loop_file with its rows in random order"""
+    with open(loop_file) as f:
+        lines = f.readlines()
+    random.Random(0).shuffle(lines)
+    os.makedirs(os.path.dirname(shuffled_file), exist_ok=True)
+    with open(shuffled_file, "w") as f:
+        f.writelines(lines)
+
+
+def check_shuffled(directory):
+    """Problems with the overlaps of the shuffled loop file, which must be the same as those of the original file"""
+    analyzed = {}
+    for name in [
+        "analyzed_example.loop",
+        "analyzed_shuffled.loop",
+        os.path.join("batch_analyzed_shuffled", "summary_table_0.loop"),
+    ]:
+        with open(os.path.join(directory, name)) as f:
+            analyzed[name] = sorted(f)
+    expected = analyzed.pop("analyzed_example.loop")
+    return [
+        f"{name} doesn't have the same overlaps as the original loop file"
+        for name, lines in analyzed.items()
+        if lines != expected
+    ]
+
+
+def check_metrics(metrics_file, commands):
+    """Problems with the metrics file written by running commands"""
+    try:
+        with open(metrics_file) as f:
+            events = [json.loads(line) for line in f]
+    except (OSError, ValueError) as e:
+        return [f"could not read metrics file {metrics_file} ({e})"]
+    recorded = [event["command"] for event in events if event["event"] == "command"]
+    if recorded != [args[0] for args in commands]:
+        return [f"commands recorded in the metrics file {recorded} don't match the commands run"]
+    return []
+
+
+@click.command()
+@click.option("--num-sims", show_default=True, default=4, type=int, help="number of simulations of each simulating command")
+@click.option("--num-processes", show_default=True, default=2, type=int, help="number of processes of each parallel command")
+@click.option("--keep-directory", type=click.Path(file_okay=False), help="if passed, outputs are kept in this directory")
+def smoke_run(num_sims, num_processes, keep_directory):
+    """Check that every loopsim command runs to completion, records its metrics and doesn't depend on the loop file order"""
+    with tempfile.TemporaryDirectory() as temp_directory:
+        directory = keep_directory or temp_directory
+        os.makedirs(directory, exist_ok=True)
+        metrics_file = os.path.join(directory, "metrics.jsonl")
+        if os.path.exists(metrics_file):
+            os.remove(metrics_file)
+        commands = smoke_commands(directory, num_sims, num_processes)
+        write_shuffled(LOOP_FILE, os.path.join(directory, "shuffled", "shuffled.loop"))
+
+        for args in commands:
+            result = subprocess.run(
+                [sys.executable, "-m", "loopsim", "--metrics-file", metrics_file, *args], capture_output=True, text=True
+            )
+            print(f"loopsim {args[0]:<14} exit status {result.returncode}")
+            # Later commands read the outputs of this one, so there is no point in running them
+            if result.returncode != 0:
+                raise click.ClickException(f"'loopsim {' '.join(args)}' failed:\n{result.stderr}")
+        failures = check_metrics(metrics_file, commands) + check_shuffled(directory)
+
+    if failures:
+        raise click.ClickException("\n".join(failures))
+    print("Smoke run passed")
+
+
+if __name__ == "__main__":
+    smoke_run()
@@ -0,0 +1,64 @@
+"""Startup time check for the loopsim CLI
+
+Usage: python benchmarks/startup_time.py --max-seconds 1.0
+
+Every command's --help is run in a fresh interpreter, which imports the command's module (and everything it needs to run)
+without doing any work. The check fails if a command other than 'visualize' imports a plotting or statistics library,
+or if the median startup time of any command is above --max-seconds.
+"""
+
+import json
+import statistics
+import subprocess
+import sys
+
+import click
+
+COMMANDS = ["validate", "simulate", "analyze", "batch-analyze", "sim-analyze", "merge", "visualize"]
+
+# Only visualize is allowed to import these
+HEAVY_MODULES = ["seaborn", "matplotlib", "scipy"]
+
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+from loopsim.cli import cli
+cli({args!r}, standalone_mode=False)
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "modules": sorted({{m.split(".")[0] for m in sys.modules}})}}))
+"""
+
+
+def startup(args):
+    """(seconds, top-level modules imported) of running the CLI with args in a fresh interpreter"""
+    result = subprocess.run(
+        [sys.executable, "-c", STARTUP_SCRIPT.format(args=args)], capture_output=True, text=True, check=True
+    ).stdout
+    startup = json.loads(result.splitlines()[-1])
+    return startup["seconds"], set(startup["modules"])
+
+
+@click.command()
+@click.option("--repeat", show_default=True, default=5, type=int, help="number of runs per command (the median is used)")
+@click.option("--max-seconds", show_default=True, default=1.0, type=float, help="fail if any command takes longer to start")
+def startup_time(repeat, max_seconds):
+    """Check that each loopsim command starts quickly and only imports what it needs"""
+    failures = []
+    for args in [["--help"], *([command, "--help"] for command in COMMANDS)]:
+        runs = [startup(args) for _ in range(repeat)]
+        seconds = statistics.median(run[0] for run in runs)
+        heavy = sorted(set(HEAVY_MODULES) & runs[0][1])
+        print(f"loopsim {' '.join(args):<24} {seconds:6.3f}s  heavy imports: {', '.join(heavy) or '-'}")
+
+        if seconds > max_seconds:
+            failures.append(f"'loopsim {' '.join(args)}' took {seconds:.3f}s to start (max {max_seconds}s)")
+        if heavy and args[0] != "visualize":
+            failures.append(f"'loopsim {' '.join(args)}' imported {', '.join(heavy)}")
+
+    if failures:
+        raise click.ClickException("\n".join(failures))
+    print("Startup time check passed")
+
+
+if __name__ == "__main__":
+    startup_time()
@@ -0,0 +1,82 @@
+"""Synthetic loop, chromosome region and interval files at configurable scale
+
+Usage: python benchmarks/synthetic.py OUTPUT_DIRECTORY --num-loops 1000000 --num-intervals 10000
+"""
+
+import os
+
+import click
+import numpy as np
+import pandas as pd
+
+EXAMPLE_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "example_data")
+HG19_REGIONS = os.path.join(EXAMPLE_DATA, "chr_region_hg19")
+
+
+def make_chr_rg(chromosome_region_file=HG19_REGIONS):
+    """Chromosome regions to generate data on (hg19 by default)"""
+    return pd.read_table(chromosome_region_file, header=None, sep=r"\s+", dtype={0: str})
+
+
+def make_loops(num_loops, chr_rg, rng):
+    """Valid loops (as 'validate' would output them) spread over the chromosomes proportionally to their length
+
+    Loop ends are 5K or 10K wide like in the Hi-C example data, and loop lengths are log-normal around 250K.
+    """
+    lengths = chr_rg[2].to_numpy(dtype=np.int64)
+    counts = rng.multinomial(num_loops, lengths / lengths.sum())
+    loops = []
+    for chr, length, count in zip(chr_rg[0], lengths, counts):
+        resolution = rng.choice([5_000, 10_000], size=count)
+        loop_length = np.maximum(resolution * 2, rng.lognormal(np.log(250_000), 0.8, size=count).astype(np.int64))
+        loop_length -= loop_length % resolution
+        start = rng.integers(1, length - loop_length - resolution - 1, size=count)
+        start -= start % resolution
+        loop_chr = pd.DataFrame(
+            {
+                0: chr,
+                1: start,
+                2: start + resolution,
+                3: chr,
+                4: start + loop_length,
+                5: start + loop_length + resolution,
+            }
+        )
+        loops.append(loop_chr.sort_values(by=[1, 2], ignore_index=True))
+    return pd.concat(loops, ignore_index=True)
+
+
+def make_intervals(num_intervals, chr_rg, rng):
+    """Intervals of interest (e.g. GWAS loci) between 1K and 300K long spread over the chromosomes"""
+    lengths = chr_rg[2].to_numpy(dtype=np.int64)
+    counts = rng.multinomial(num_intervals, lengths / lengths.sum())
+    intervals = []
+    for chr, length, count in zip(chr_rg[0], lengths, counts):
+        interval_length = rng.integers(1_000, 300_000, size=count)
+        start = np.sort(rng.integers(1, length - interval_length))
+        intervals.append(pd.DataFrame({0: chr, 1: start, 2: start + interval_length}))
+    return pd.concat(intervals, ignore_index=True)
+
+
+def write_table(table, filename):
+    table.to_csv(filename, header=None, index=None, sep="\t")
+
+
+@click.command()
+@click.argument("output_directory", type=click.Path(exists=False, file_okay=False, dir_okay=True, writable=True))
+@click.option("--num-loops", show_default=True, default=10_000, type=int, help="number of loops")
+@click.option("--num-intervals", show_default=True, default=100, type=int, help="number of intervals of interest")
+@click.option("--seed", show_default=True, default=0, type=int, help="random seed")
+def synthetic(output_directory, num_loops, num_intervals, seed):
+    """Write a synthetic loop file, chromosome region file and intervals file to OUTPUT_DIRECTORY"""
+    os.makedirs(output_directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    chr_rg = make_chr_rg()
+    write_table(chr_rg, os.path.join(output_directory, "chr_region"))
+    write_table(make_loops(num_loops, chr_rg, rng), os.path.join(output_directory, f"loops_{num_loops}.loop"))
+    write_table(make_intervals(num_intervals, chr_rg, rng), os.path.join(output_directory, f"intervals_{num_intervals}"))
+    print(f"Outputted synthetic data to {output_directory}")
+
+
+if __name__ == "__main__":
+    synthetic()
@@ -1,70 +1,318 @@
 """loop analysis and empirical distribution"""
 # Invariant: we are assuming that the loop files passed in are all valid
 
+import contextlib
+import os
 
 import click
 import numpy as np
 import pandas as pd
 
-from . import common
+from . import common, metrics
+from .store import SimulationStore, is_store
 
 
 @click.command()
 @click.argument("loop_in_file", type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True))
 @click.argument("loop_out_file", type=click.Path(exists=False, file_okay=True, dir_okay=False, writable=True))
-@click.argument("intervals_file", type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True))
-def analyze(loop_in_file, loop_out_file, intervals_file):
+@click.argument(
+    "intervals_files", nargs=-1, required=True, type=click.Path(exists=True, file_okay=True, dir_okay=True, readable=True)
+)
+@click.option(
+    "--sim-index",
+    show_default=True,
+    default=0,
+    type=int,
+    help="which simulation to analyze if LOOP_IN_FILE is a binary store from 'simulate --output-format npy'",
+)
+@click.option(
+    "--output-format",
+    show_default=True,
+    default="text",
+    type=click.Choice(["text", "sparse"]),
+    help="'text' outputs the loop file with the overlaps as extra columns, 'sparse' outputs only the overlaps as a sparse "
+    "loop-by-interval matrix (.npz) that is much faster to write and read back",
+)
+@click.option(
+    "--streaming",
+    is_flag=True,
+    help="read and analyze LOOP_IN_FILE one chromosome at a time, for loop files too big to load at once (the rows of each "
+    "chromosome must be together, as in the output of 'validate')",
+)
+def analyze(loop_in_file, loop_out_file, intervals_files, sim_index, output_format, streaming):
     """Perform analysis on a single loop file
 
     Output the inputted loop file with an extra column.
-    Each row of the extra column will have the indices in the reference file that the loop on that row overlaps with."""
+    Each row of the extra column will have the indices in the reference file that the loop on that row overlaps with.
+
+    INTERVALS_FILES can be one or more intervals files or directories of them. The loop file is scored against every
+    intervals set in one pass, and the output gets one extra column per set (in the order they are printed).
+
+    With --output-format sparse, LOOP_OUT_FILE is instead an .npz file with the (loop row, interval row) coordinates of every overlap
+    for each intervals set (see write_overlap_pairs for its layout).
+
+    LOOP_IN_FILE can also be a binary store (sim_hi-c.npy), in which case simulation --sim-index is analyzed.
+
+    With --streaming, each chromosome of LOOP_IN_FILE is analyzed and written out before the next one is read,
+    so memory use depends on the largest chromosome rather than the whole loop file. The output is the same as without it."""
+    intervals_sets = list_intervals_files(intervals_files)
+    if streaming and is_store(loop_in_file):
+        raise click.UsageError("--streaming only applies to loop files (a binary store is never loaded at once anyway)")
 
     # Print params
     print(f"Input loop file: {loop_in_file}")
     print(f"Output loop file: {loop_out_file}")
-    print(f"Intervals file: {intervals_file}")
+    for intervals_file in intervals_sets.values():
+        print(f"Intervals file: {intervals_file}")
     print(f"Delimiter for output: '{common.delimiter}'")
 
     # Get intervals
-    intervals = pd.read_table(intervals_file, header=None, delimiter=common.detect_delimiter(intervals_file))
+    intervals_indexes = [
+        IntervalsIndex(common.read_table(intervals_file, "intervals")) for intervals_file in intervals_sets.values()
+    ]
 
     # Do analysis
     ratios = []
-    loop_out = analyze_loop_file(loop_in_file, intervals, ratios)
+    if is_store(loop_in_file):
+        store = SimulationStore(loop_in_file)
+        if sim_index not in store.sims:
+            raise click.UsageError(f"--sim-index must be between {store.sims.start} and {store.sims.stop - 1} for {loop_in_file}")
+        if output_format == "sparse":
+            num_loops = store.num_loops
+            overlap_pairs = find_overlap_pairs(store_blocks(store, sim_index), intervals_indexes)
+        else:
+            loop_out = store.to_dataframe(sim_index)
+            for k, overlaps in enumerate(analyze_store_sim(store, sim_index, intervals_indexes, ratios)):
+                loop_out[6 + k] = overlaps
+    elif streaming:
+        num_loops, overlap_pairs = analyze_loop_file_streaming(loop_in_file, loop_out_file, intervals_indexes, output_format)
+    elif output_format == "sparse":
+        loop_in = common.read_table(loop_in_file, "loop")
+        num_loops = len(loop_in)
+        overlap_pairs = find_overlap_pairs(loop_blocks(loop_in), intervals_indexes)
+    else:
+        loop_out = analyze_loop_file(loop_in_file, intervals_indexes, ratios)
 
     # Output analysis
-    loop_out.to_csv(loop_out_file, header=None, index=None, sep=common.delimiter)
+    with metrics.timer("write", file=loop_out_file):
+        if output_format == "sparse":
+            write_overlap_pairs(loop_out_file, overlap_pairs, num_loops, intervals_indexes, intervals_sets)
+        elif not streaming:
+            loop_out.to_csv(loop_out_file, header=None, index=None, sep=common.delimiter)
+    if output_format == "sparse" or streaming:
+        ratios = [overlap_ratio(pairs, num_loops) for pairs in overlap_pairs]
     print(f"Outputted analyzed loop file to {loop_out_file}")
-    print(f"Ratio of overlapping intervals out of the total number of loops was: {ratios[0]}")
+    if len(intervals_sets) == 1:
+        print(f"Ratio of overlapping intervals out of the total number of loops was: {ratios[0]}")
+    else:
+        for k, (name, ratio) in enumerate(zip(intervals_sets, ratios)):
+            column = f" (column {7 + k})" if output_format == "text" else ""
+            print(f"Ratio of overlapping intervals out of the total number of loops for {name}{column} was: {ratio}")
+
+
+def list_intervals_files(paths):
+    """Expand intervals files and directories of intervals files into {set name: file}, the set name being the file name"""
+    intervals_sets = {}
+    for path in paths:
+        if os.path.isdir(path):
+            filenames = sorted((f for f in os.listdir(path) if not f.startswith(".")), key=common.natural_sort_key)
+            files = [os.path.join(path, filename) for filename in filenames]
+        else:
+            files = [path]
+        for file in files:
+            name = os.path.basename(file)
+            if name in intervals_sets:
+                raise click.UsageError(f"intervals files {intervals_sets[name]} and {file} have the same name")
+            intervals_sets[name] = file
+    if not intervals_sets:
+        raise click.UsageError(f"no intervals files found in {', '.join(paths)}")
+    return intervals_sets
 
 
-def analyze_loop_file(loop_in_file, intervals, ratios):
+def analyze_loop_file(loop_in_file, intervals_indexes, ratios):
     """ratios isn't used here but is used for batch analysis"""
-    loop_in = pd.read_table(loop_in_file, header=None, delimiter=common.detect_delimiter(loop_in_file))
+    loop_in = common.read_table(loop_in_file, "loop")
+    with metrics.timer("analyze", file=loop_in_file, interval_sets=len(intervals_indexes)):
+        return analyze_loop(loop_in, intervals_indexes, ratios)
 
-    loop_in[0] = loop_in[0].astype("unicode")
-    intervals[0] = intervals[0].astype("unicode")
 
-    loop_in[6] = loop_in.apply(is_overlapping_hic, axis=1, args=(intervals,))
+def analyze_loop_file_streaming(loop_in_file, loop_out_file, intervals_indexes, output_format):
+    """Same as analyze_loop_file, but one chromosome at a time (see common.read_chromosome_blocks)
 
-    ratios.append(len(loop_in.loc[loop_in[6].notnull()]) / len(loop_in))
+    With text output, each chromosome is written to loop_out_file as soon as it is analyzed. Only the sparse overlaps are kept
+    for the whole file, and they are returned with the number of loops, like find_overlap_pairs."""
+    num_loops = 0
+    pairs = [([], []) for _ in intervals_indexes]
+    with open(loop_out_file, "w") if output_format == "text" else contextlib.nullcontext() as loop_out:
+        for chr, loop_chr in common.read_chromosome_blocks(loop_in_file, "loop"):
+            with metrics.timer("analyze", file=loop_in_file, chromosome=chr, interval_sets=len(intervals_indexes)):
+                pairs_chr = find_overlap_pairs(loop_blocks(loop_chr), intervals_indexes)
+            for k, ((loops, intervals), (loops_chr, intervals_chr)) in enumerate(zip(pairs, pairs_chr)):
+                loops.append(loops_chr + num_loops)
+                intervals.append(intervals_chr)
+                if loop_out is not None:
+                    loop_chr[6 + k] = overlaps_column((loops_chr, intervals_chr), len(loop_chr))
+            if loop_out is not None:
+                with metrics.timer("write", file=loop_out_file, chromosome=chr):
+                    loop_chr.to_csv(loop_out, header=None, index=None, sep=common.delimiter)
+            num_loops += len(loop_chr)
+    return num_loops, [
+        (np.concatenate(loops or [EMPTY_ROWS]), np.concatenate(intervals or [EMPTY_ROWS])) for loops, intervals in pairs
+    ]
+
+
+def analyze_loop(loop_in, intervals_indexes, ratios):
+    """Same as analyze_loop_file, but for a loop dataframe that is already in memory (e.g. a fresh simulation)
+
+    The overlaps with the k-th intervals set go into column 6 + k, and the ratio of each set is appended to ratios."""
+    for k, pairs in enumerate(find_overlap_pairs(loop_blocks(loop_in), intervals_indexes)):
+        loop_in[6 + k] = overlaps_column(pairs, len(loop_in))
+        ratios.append(overlap_ratio(pairs, len(loop_in)))
 
     return loop_in
 
 
-def ranges_overlap(x_start, x_end, y_start, y_end):
-    """do ranges overlap? (boundaries being the same counts as overlapping)"""
-    return x_start <= y_end and y_start <= x_end
+def analyze_store_sim(store, sim_name, intervals_indexes, ratios):
+    """Same as analyze_loop_file, but for a simulation in a binary store
+
+    The coordinates are read straight from the memory map, and only the overlaps columns (one per intervals set) are returned"""
+    with metrics.timer("analyze", file=store.path, sim=int(sim_name), interval_sets=len(intervals_indexes)):
+        overlap_pairs = find_overlap_pairs(store_blocks(store, sim_name), intervals_indexes)
+
+    overlaps = []
+    for pairs in overlap_pairs:
+        overlaps.append(overlaps_column(pairs, store.num_loops))
+        ratios.append(overlap_ratio(pairs, store.num_loops))
+
+    return overlaps
+
+
+def loop_blocks(loop_in):
+    """Iterate over (chromosome, rows, loop starts, loop ends) of each chromosome in a loop dataframe"""
+    for chr, loop_chr in loop_in.groupby(0, sort=False, observed=True):
+        yield str(chr), loop_in.index.get_indexer(loop_chr.index), loop_chr[1].to_numpy(), loop_chr[5].to_numpy()
+
+
+def store_blocks(store, sim_name):
+    """Same as loop_blocks, but for a simulation in a binary store"""
+    for chr, rows, coords in store.chromosome_blocks(sim_name):
+        yield chr, np.arange(rows.start, rows.stop), coords[:, 0], coords[:, 3]
+
+
+def find_overlap_pairs(blocks, intervals_indexes):
+    """Sparse overlaps of the loops in blocks (see loop_blocks) with each intervals set
+
+    Returns one (loop rows, interval rows) pair of arrays per set, i.e. the COO coordinates of a loop-by-interval matrix,
+    sorted by loop row and then interval row"""
+    pairs = [([], []) for _ in intervals_indexes]
+    for chr, rows, loop_starts, loop_ends in blocks:
+        for (loops, intervals), intervals_index in zip(pairs, intervals_indexes):
+            loops_chr, intervals_chr = intervals_index.overlap_pairs(chr, loop_starts, loop_ends)
+            loops.append(rows[loops_chr])
+            intervals.append(intervals_chr)
+    return [
+        sort_pairs(np.concatenate(loops or [EMPTY_ROWS]), np.concatenate(intervals or [EMPTY_ROWS])) for loops, intervals in pairs
+    ]
+
+
+def sort_pairs(loops, intervals):
+    """(loop rows, interval rows) sorted by loop row and then interval row
+
+    Each chromosome's pairs are already sorted, so this only sorts when a loop file's chromosomes are not grouped together."""
+    if np.all(loops[1:] >= loops[:-1]):
+        return loops, intervals
+    order = np.lexsort((intervals, loops))
+    return loops[order], intervals[order]
+
+
+def overlaps_column(pairs, num_loops):
+    """Overlaps as an object column: the sorted interval rows that each loop overlaps with (NaN for no overlaps)"""
+    loops, intervals = pairs
+    column = np.full(num_loops, np.nan, dtype=object)
+    hit_loops, first = np.unique(loops, return_index=True)
+    for loop, overlapping in zip(hit_loops, np.split(intervals, first[1:])):
+        column[loop] = overlapping
+    return column
+
+
+def overlap_ratio(pairs, num_loops):
+    """Fraction of the loops that overlap with at least one interval"""
+    return len(np.unique(pairs[0])) / num_loops
+
+
+def interval_hit_counts(pairs, num_intervals):
+    """Number of loops overlapping each interval"""
+    return np.bincount(pairs[1], minlength=num_intervals)
+
+
+def write_overlap_pairs(filename, overlap_pairs, num_loops, intervals_indexes, intervals_set_names):
+    """Output the overlaps with each intervals set as a sparse loop-by-interval matrix
+
+    The .npz file has the names of the sets ("sets"), the number of loops ("num_loops"), and for the k-th set the COO coordinates
+    of its matrix ("loops_k" and "intervals_k", every entry being 1) and its number of intervals ("num_intervals_k"),
+    e.g. scipy.sparse.coo_matrix((np.ones(len(loops_k)), (loops_k, intervals_k)), shape=(num_loops, num_intervals_k))."""
+    arrays = {"sets": np.array(list(intervals_set_names)), "num_loops": num_loops}
+    for k, ((loops, intervals), intervals_index) in enumerate(zip(overlap_pairs, intervals_indexes)):
+        arrays[f"loops_{k}"] = loops
+        arrays[f"intervals_{k}"] = intervals
+        arrays[f"num_intervals_{k}"] = intervals_index.num_intervals
+    # Writing to an open file keeps numpy from adding .npz to the filename
+    with open(filename, "wb") as f:
+        np.savez(f, **arrays)
+
+
+EMPTY_ROWS = np.array([], dtype=np.int64)
+
+# Maximum number of (loop, candidate interval) pairs checked at once
+CANDIDATE_CHUNK = 1 << 20
+
+
+class IntervalsIndex:
+    """Intervals of interest split by chromosome and sorted by start, for batched overlap queries
+
+    Build this once per intervals file and reuse it for every loop file analyzed against it."""
+
+    def __init__(self, intervals: pd.DataFrame):
+        self.num_intervals = len(intervals)
+        self.chromosomes = {}
+        for chr, intervals_chr in intervals.groupby(0, sort=False, observed=True):
+            order = np.argsort(intervals_chr[1].to_numpy(), kind="stable")
+            starts = intervals_chr[1].to_numpy()[order]
+            ends = intervals_chr[2].to_numpy()[order]
+            # Running max of the ends lets us skip every interval that ends before a loop starts
+            max_ends = np.maximum.accumulate(ends)
+            self.chromosomes[str(chr)] = (starts, ends, max_ends, intervals_chr.index.to_numpy()[order])
+
+    def overlap_pairs(self, chr, loop_starts, loop_ends):
+        """check which intervals each loop on chr overlaps with (boundaries being the same counts as overlapping)
+
+        Returns (positions in loop_starts, interval rows) of every overlapping pair, sorted by position and then interval row"""
+        if chr not in self.chromosomes:
+            return EMPTY_ROWS, EMPTY_ROWS
+        starts, ends, max_ends, labels = self.chromosomes[chr]
+
+        # Only intervals in [lo, hi) can overlap: before lo they all end too early, from hi on they all start too late
+        lo = np.searchsorted(max_ends, loop_starts, side="left")
+        hi = np.searchsorted(starts, loop_ends, side="right")
+        num_candidates = np.maximum(hi - lo, 0)
 
+        # Expand the candidate ranges into (loop, candidate) pairs, a bounded number of pairs at a time
+        cumulative = np.cumsum(num_candidates)
+        loops, intervals = [], []
+        chunk_start = 0
+        while chunk_start < len(loop_starts):
+            done = cumulative[chunk_start - 1] if chunk_start else 0
+            chunk_end = max(chunk_start + 1, np.searchsorted(cumulative, done + CANDIDATE_CHUNK, side="right"))
+            counts = num_candidates[chunk_start:chunk_end]
+            chunk_loops = np.repeat(np.arange(chunk_start, chunk_end), counts)
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            candidates = np.repeat(lo[chunk_start:chunk_end], counts) + offsets
+            overlapping = ends[candidates] >= loop_starts[chunk_loops]
+            loops.append(chunk_loops[overlapping])
+            intervals.append(labels[candidates[overlapping]])
+            chunk_start = chunk_end
 
-def is_overlapping_hic(loop, intervals):
-    """check if loop has overlaps with an interval of interest (return indices)"""
-    intervals_chr = intervals.loc[intervals[0] == loop[0]]
-    loop_start = loop[1]
-    loop_end = loop[5]
-    overlaps = intervals_chr.apply(
-        lambda row, start, end: ranges_overlap(row[1], row[2], start, end), args=(loop_start, loop_end), axis=1
-    )
-    if len(overlaps[overlaps].index.values):
-        return overlaps[overlaps].index.values
-    return np.NaN
+        loops = np.concatenate(loops or [EMPTY_ROWS])
+        intervals = np.concatenate(intervals or [EMPTY_ROWS])
+        order = np.lexsort((intervals, loops))
+        return loops[order], intervals[order]
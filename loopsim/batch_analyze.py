@@ -1,18 +1,39 @@
 """Batch loop analysis and empirical distribution"""
 # Invariant: we are assuming that the loop files passed in are all valid
 
+import hashlib
+import multiprocessing as mp
 import os
 
 import click
+import numpy as np
 import pandas as pd
 
-from . import common
-from .analyze import analyze_loop_file
+from . import common, metrics
+from .analyze import (
+    IntervalsIndex,
+    find_overlap_pairs,
+    interval_hit_counts,
+    list_intervals_files,
+    loop_blocks,
+    overlap_ratio,
+    overlaps_column,
+    store_blocks,
+    write_overlap_pairs,
+)
+from .merge import make_provenance, write_provenance
+from .result_cache import ResultCache
+from .store import SimulationStore, is_store
+
+# Inputs shared by every task in a worker process (set by init_worker)
+_worker = {}
 
 
 @click.command()
 @click.argument("loop_in_directory", type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True))
-@click.argument("intervals_file", type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True))
+@click.argument(
+    "intervals_files", nargs=-1, required=True, type=click.Path(exists=True, file_okay=True, dir_okay=True, readable=True)
+)
 @click.argument(
     "overlapping_ratio_distribution_file", type=click.Path(exists=False, file_okay=True, dir_okay=False, writable=True)
 )
@@ -21,7 +42,72 @@ from .analyze import analyze_loop_file
     type=click.Path(exists=False, file_okay=False, dir_okay=True, writable=True),
     help="if passed, will output summary table for each file in LOOP_IN_DIRECTORY to specified directory (omit for speed)",
 )
-def batch_analyze(loop_in_directory, intervals_file, overlapping_ratio_distribution_file, loop_out_directory):
+@click.option(
+    "--num-processes",
+    type=int,
+    help="number of threads to use                          [default: max(1, round(multiprocessing.cpu_count() / 2))]",
+)
+@click.option(
+    "--loop-out-format",
+    show_default=True,
+    default="text",
+    type=click.Choice(["text", "sparse"]),
+    help="format of the summary tables in --loop-out-directory (see 'analyze --output-format')",
+)
+@click.option(
+    "--loop-out-compression",
+    show_default=True,
+    default="none",
+    type=click.Choice(list(common.OUTPUT_COMPRESSIONS)),
+    help="compression of the text summary tables in --loop-out-directory (summary_table_0.loop.gz with gzip, .zst with zstd)",
+)
+@click.option(
+    "--interval-hits-file",
+    type=click.Path(exists=False, file_okay=True, dir_okay=False, writable=True),
+    help="if passed, will output the intervals file with two extra columns: the number of loop files in which each interval "
+    "overlapped a loop, and the total number of loops that overlapped it",
+)
+@click.option(
+    "--result-cache",
+    type=click.Path(exists=False, file_okay=False, dir_okay=True, writable=True),
+    help="if passed, the ratio and overlaps of every loop file are cached in this directory (keyed by the content of the loop "
+    "and intervals files), so reruns only analyze new or changed loop files",
+)
+@click.option(
+    "--result-cache-size",
+    show_default=True,
+    default=1024,
+    type=int,
+    help="maximum size of --result-cache in MB (the least recently used results are removed after each run)",
+)
+@click.option(
+    "--shard-index",
+    show_default=True,
+    default=0,
+    type=int,
+    help="which shard of the loop files to analyze (0 to --shard-count - 1)",
+)
+@click.option(
+    "--shard-count",
+    show_default=True,
+    default=1,
+    type=int,
+    help="split the loop files into this many shards that can be analyzed independently (combine their outputs with 'merge')",
+)
+def batch_analyze(
+    loop_in_directory,
+    intervals_files,
+    overlapping_ratio_distribution_file,
+    loop_out_directory,
+    num_processes,
+    loop_out_format,
+    loop_out_compression,
+    interval_hits_file,
+    result_cache,
+    result_cache_size,
+    shard_index,
+    shard_count,
+):
     """Perform analysis on a distribution of loop files
 
     If --loop-out-directory is not passed, this command will be like running 'analyze' on every file in LOOP_IN_DIRECTORY (i.e it will not save the summary file for each file in LOOP_IN_DIRECTORY)
@@ -29,15 +115,55 @@ def batch_analyze(loop_in_directory, intervals_file, overlapping_ratio_distribut
     NOTE: any data in --loop_out_directory may be overwritten!!
 
     NOTE: OVERLAPPING_RATIO_DISTRIBUTION_FILE will only contain nonzero ratios (i.e. loops that have >=1 overlap with an interval of interest)
+
+    Files in LOOP_IN_DIRECTORY are analyzed in natural sort order (sim_hi-c_2.loop before sim_hi-c_10.loop),
+    which is also the order of the ratios and the numbering of the summary tables. Loop files can be gzip or zstd compressed.
+    Hidden files and the temporary files of an unfinished 'simulate' (*.tmp) are skipped.
+
+    If LOOP_IN_DIRECTORY holds a binary store from 'simulate --output-format npy', its completed simulations are analyzed in order instead.
+
+    INTERVALS_FILES can be one or more intervals files or directories of them. Every loop file is read once and scored against all
+    intervals sets. With more than one set, there is one ratio distribution file per set, named after OVERLAPPING_RATIO_DISTRIBUTION_FILE
+    with the set name added (ratios.txt -> ratios_<set name>.txt), and the summary tables get one extra column per set.
+
+    --interval-hits-file gives the null distribution of every interval of interest in the same pass (so the summary tables are
+    not needed for it). Like the ratio distributions, there is one file per intervals set if there are several.
+
+    With --shard-count, only shard --shard-index of the loop files is analyzed, and a provenance file is written next to each
+    ratio distribution file so the shards can be combined with 'merge'. A binary store written by a sharded 'simulate'
+    is analyzed as the shard it holds.
+
+    With --result-cache, the result of every loop file (or simulation in a binary store) against every intervals file is kept
+    in a cache directory that can be shared by runs. A rerun, e.g. after adding simulations to LOOP_IN_DIRECTORY,
+    then only analyzes the loop files it hasn't seen, and gives the same ratios in the same order as analyzing everything.
     """
+    intervals_sets = list_intervals_files(intervals_files)
+    if loop_out_compression != "none" and loop_out_format != "text":
+        raise click.UsageError("--loop-out-compression only applies to --loop-out-format text")
+    common.check_compression(loop_out_compression)
+
+    # Set number of processes if not passed in by user
+    if num_processes is None:
+        num_processes = max(1, round(mp.cpu_count() / 2))
 
     # Print params
     print(f"Input loop files directory: {loop_in_directory}")
-    print(f"Intervals file: {intervals_file}")
-    print(f"Ratio distribution file: {overlapping_ratio_distribution_file}")
+    distribution_files = per_set_files(overlapping_ratio_distribution_file, intervals_sets)
+    for intervals_file, distribution_file in zip(intervals_sets.values(), distribution_files):
+        print(f"Intervals file: {intervals_file}")
+        print(f"Ratio distribution file: {distribution_file}")
+    print(f"Number of processes: {num_processes}")
     print(f"Delimiter for output: '{common.delimiter}'")
     if loop_out_directory:
         print(f"Output loop files directory: {loop_out_directory}")
+        print(f"Output loop files format: {loop_out_format}")
+        if loop_out_compression != "none":
+            print(f"Output loop files compression: {loop_out_compression}")
+    interval_hits_files = per_set_files(interval_hits_file, intervals_sets) if interval_hits_file else []
+    for hits_file in interval_hits_files:
+        print(f"Interval hits file: {hits_file}")
+    if result_cache:
+        print(f"Result cache directory: {result_cache} (up to {result_cache_size} MB)")
 
     # Get data dir sorted out
     if loop_out_directory and not os.path.isdir(loop_out_directory):
@@ -45,24 +171,196 @@ def batch_analyze(loop_in_directory, intervals_file, overlapping_ratio_distribut
         os.makedirs(loop_out_directory)
         print("Output directory created!")
 
-    # Get intervals
-    intervals = pd.read_table(intervals_file, header=None, delimiter=common.detect_delimiter(intervals_file))
-
-    # Do analysis for all input loop files
-    ratios = []
-    # this if/else with repeated code is ugly as hell but probably worth the optimization (though with python idk ;) )
+    # Do analysis for all input loop files (or all simulations in the binary store) of this shard
+    if is_store(loop_in_directory):
+        store_file = loop_in_directory
+        store = SimulationStore(store_file)
+        num_sims = store.num_sims
+        if (shard_index, shard_count) == (0, 1):
+            shard_index, shard_count = store.shard_index, store.shard_count
+        if (shard_index, shard_count) != (store.shard_index, store.shard_count) and store.shard_count != 1:
+            raise click.UsageError(
+                f"{loop_in_directory} holds shard {store.shard_index} of {store.shard_count}, not shard {shard_index} of {shard_count}"
+            )
+        sims = common.shard_sims(num_sims, shard_index, shard_count)
+        # Simulations are numbered the same as in 'simulate' (which is also the numbering of the summary tables)
+        tasks = [(int(sim_name), int(sim_name)) for sim_name in store.completed_sims() if sim_name in sims]
+        # What identifies the simulations of the run in the provenance of a shard (a store only holds its own shard)
+        loop_inputs, seed, loop_files = {"loop_in_directory": loop_in_directory}, store.seed, store.layout_sha256()
+    else:
+        store_file = None
+        filenames = common.list_loop_files(loop_in_directory)
+        num_sims = len(filenames)
+        sims = common.shard_sims(num_sims, shard_index, shard_count)
+        tasks = [(i, os.path.join(loop_in_directory, filenames[i])) for i in sims]
+        # Every shard lists the whole directory, so the file names and the first file are the same for every shard of the run
+        loop_inputs = {"loop_in_directory": loop_in_directory}
+        if filenames:
+            loop_inputs["first_loop_file"] = os.path.join(loop_in_directory, filenames[0])
+        seed, loop_files = None, hashlib.sha256("\n".join(filenames).encode()).hexdigest()
+    if shard_count > 1:
+        print(f"Shard: {shard_index} of {shard_count} ({len(tasks)} of {num_sims} loop files)")
+    with mp.Pool(
+        num_processes,
+        initializer=init_worker,
+        initargs=(
+            list(intervals_sets.values()),
+            store_file,
+            loop_out_directory,
+            loop_out_format,
+            loop_out_compression,
+            bool(interval_hits_file),
+            result_cache,
+            [common.file_sha256(intervals_file) for intervals_file in intervals_sets.values()] if result_cache else None,
+            common.get_settings(),
+        ),
+    ) as pool:
+        # imap keeps the ratios in the same order as the files (one row per file, one column per intervals set)
+        ratios = []
+        sims_hit = loops_hit = None
+        num_cached = 0
+        for file_ratios, hit_counts, cached in pool.imap(analyze_sim_file, tasks):
+            ratios.append(file_ratios)
+            num_cached += cached
+            if interval_hits_file:
+                if sims_hit is None:
+                    sims_hit = [np.zeros_like(counts) for counts in hit_counts]
+                    loops_hit = [np.zeros_like(counts) for counts in hit_counts]
+                for k, counts in enumerate(hit_counts):
+                    sims_hit[k] += counts > 0
+                    loops_hit[k] += counts
+        ratios = pd.DataFrame(ratios, columns=range(len(intervals_sets)))
+        pool.close()
+        pool.join()
     if loop_out_directory:
-        for i, filename in enumerate(os.listdir(loop_in_directory)):
-            sim_file = os.path.join(loop_in_directory, filename)
-            loop_out = analyze_loop_file(sim_file, intervals, ratios)
-            output_filepath = f"{loop_out_directory}/summary_table_{i}.loop"
-            loop_out.to_csv(output_filepath, header=None, index=None, sep=common.delimiter)
         print(f"Finished outputting analyzed files to {loop_out_directory}")
-    else:
-        for filename in os.listdir(loop_in_directory):
-            sim_file = os.path.join(loop_in_directory, filename)
-            analyze_loop_file(sim_file, intervals, ratios)
+    if result_cache:
+        num_evicted = ResultCache(result_cache, result_cache_size * 2**20).evict()
+        num_results = len(tasks) * len(intervals_sets)
+        print(f"Result cache: {num_cached} of {num_results} results were cached ({num_evicted} old results removed)")
+
+    # Output interval hit counts
+    for k, (intervals_file, hits_file) in enumerate(zip(intervals_sets.values(), interval_hits_files)):
+        intervals = common.read_table(intervals_file, "intervals")
+        num_columns = len(intervals.columns)
+        intervals[num_columns] = sims_hit[k] if sims_hit is not None else 0
+        intervals[num_columns + 1] = loops_hit[k] if loops_hit is not None else 0
+        with metrics.timer("write", file=hits_file):
+            intervals.to_csv(hits_file, header=None, index=None, sep=common.delimiter)
+        print(f"Finished outputting interval hits to {hits_file}")
 
     # Output ratios
-    pd.Series(ratios).to_csv(overlapping_ratio_distribution_file, header=None, index=None, sep=common.delimiter)
-    print(f"Finished outputting ratio distribution to {overlapping_ratio_distribution_file}")
+    for k, (name, distribution_file) in enumerate(zip(intervals_sets, distribution_files)):
+        with metrics.timer("write", file=distribution_file):
+            ratios[k].to_csv(distribution_file, header=None, index=None, sep=common.delimiter)
+        if shard_count > 1:
+            sim_names = [i for i, _ in tasks]
+            provenance = make_provenance(
+                "batch-analyze",
+                sim_names,
+                num_sims,
+                shard_index,
+                shard_count,
+                {**loop_inputs, "intervals_file": intervals_sets[name]},
+                seed=seed,
+                loop_files=loop_files,
+                intervals_set=name,
+            )
+            write_provenance(distribution_file, provenance)
+        print(f"Finished outputting ratio distribution to {distribution_file}")
+
+
+def per_set_files(filename, intervals_sets):
+    """Output file of each intervals set (just filename if there is only one set, else the set name is added to it)"""
+    if len(intervals_sets) == 1:
+        return [filename]
+    root, ext = os.path.splitext(filename)
+    return [f"{root}_{name}{ext}" for name in intervals_sets]
+
+
+def init_worker(
+    intervals_files,
+    store_file,
+    loop_out_directory,
+    loop_out_format,
+    loop_out_compression,
+    keep_interval_hits,
+    result_cache,
+    intervals_hashes,
+    settings,
+):
+    """Read the intervals and build their indexes once per worker process instead of once per task"""
+    common.set_settings(settings)
+    _worker["intervals_indexes"] = [
+        IntervalsIndex(common.read_table(intervals_file, "intervals")) for intervals_file in intervals_files
+    ]
+    _worker["store"] = SimulationStore(store_file) if store_file else None
+    _worker["intervals_set_names"] = [os.path.basename(intervals_file) for intervals_file in intervals_files]
+    _worker["loop_out_directory"] = loop_out_directory
+    _worker["loop_out_format"] = loop_out_format
+    _worker["loop_out_compression"] = loop_out_compression
+    _worker["keep_interval_hits"] = keep_interval_hits
+    # Entries are only added here; the main process evicts old ones once all workers are done
+    _worker["result_cache"] = ResultCache(result_cache, None) if result_cache else None
+    _worker["intervals_hashes"] = intervals_hashes
+
+
+def analyze_sim_file(task):
+    """Analyze the i-th simulated loop file (or simulation in the store) and output its summary table if requested
+
+    Returns its ratios, if interval hits are kept the number of loops overlapping each interval (one array per intervals set),
+    and how many of its results (one per intervals set) came from the result cache
+    """
+    i, sim_file = task
+    intervals_indexes = _worker["intervals_indexes"]
+    store = _worker["store"]
+    result_cache = _worker["result_cache"]
+    with metrics.timer("batch_analyze_task", task=True, sim=i) as fields:
+        # Look up the results of every intervals set in the cache, and only analyze the sets that aren't there
+        results = [None] * len(intervals_indexes)
+        if result_cache is not None:
+            loop_sha256 = store.sim_sha256(sim_file) if store is not None else common.file_sha256(sim_file)
+            results = [result_cache.get(loop_sha256, intervals_sha256) for intervals_sha256 in _worker["intervals_hashes"]]
+        missing = [k for k, result in enumerate(results) if result is None]
+        fields["cached"] = len(intervals_indexes) - len(missing)
+
+        loop_in = None
+        if missing:
+            if store is not None:
+                num_loops = store.num_loops
+                blocks = store_blocks(store, sim_file)
+            else:
+                loop_in = common.read_table(sim_file, "loop")
+                num_loops = len(loop_in)
+                blocks = loop_blocks(loop_in)
+            with metrics.timer("analyze", sim=i, interval_sets=len(missing)):
+                missing_pairs = find_overlap_pairs(blocks, [intervals_indexes[k] for k in missing])
+            for k, pairs in zip(missing, missing_pairs):
+                results[k] = num_loops, overlap_ratio(pairs, num_loops), pairs
+                if result_cache is not None:
+                    result_cache.put(loop_sha256, _worker["intervals_hashes"][k], *results[k])
+        num_loops = results[0][0]
+        ratios = [ratio for _, ratio, _ in results]
+        overlap_pairs = [pairs for _, _, pairs in results]
+
+        if _worker["loop_out_directory"] and _worker["loop_out_format"] == "sparse":
+            output_filepath = f"{_worker['loop_out_directory']}/summary_table_{i}.npz"
+            with metrics.timer("write", file=output_filepath, sim=i):
+                write_overlap_pairs(output_filepath, overlap_pairs, num_loops, intervals_indexes, _worker["intervals_set_names"])
+        elif _worker["loop_out_directory"]:
+            if store is not None:
+                loop_out = store.to_dataframe(sim_file)
+            else:
+                loop_out = loop_in if loop_in is not None else common.read_table(sim_file, "loop")
+            for k, pairs in enumerate(overlap_pairs):
+                loop_out[6 + k] = overlaps_column(pairs, num_loops)
+            # Compressing here spreads the compression over the worker processes
+            compression = _worker["loop_out_compression"]
+            output_filepath = f"{_worker['loop_out_directory']}/summary_table_{i}.loop{common.OUTPUT_COMPRESSIONS[compression]}"
+            with metrics.timer("write", file=output_filepath, sim=i), common.open_output(output_filepath, compression) as f:
+                loop_out.to_csv(f, header=None, index=None, sep=common.delimiter)
+
+    hit_counts = None
+    if _worker["keep_interval_hits"]:
+        hit_counts = [interval_hit_counts(pairs, index.num_intervals) for pairs, index in zip(overlap_pairs, intervals_indexes)]
+    return ratios, hit_counts, fields["cached"]
@@ -1,32 +1,68 @@
+import importlib
+
 import click
 
 from loopsim import __version__
 
-from . import common
-from .analyze import analyze
-from .batch_analyze import batch_analyze
-from .simulate import simulate
-from .validate import validate
-from .visualize import visualize
+from . import common, metrics
+
+
+class LazyGroup(click.Group):
+    """Group that only imports a subcommand's module when the subcommand is looked up
+
+    Running one command then doesn't pay for importing the dependencies of every other command."""
+
+    def __init__(self, *args, lazy_subcommands=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # command name -> "module.command object"
+        self.lazy_subcommands = lazy_subcommands or {}
+
+    def list_commands(self, ctx):
+        return sorted([*super().list_commands(ctx), *self.lazy_subcommands])
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name not in self.lazy_subcommands:
+            return super().get_command(ctx, cmd_name)
+        module_name, command_name = self.lazy_subcommands[cmd_name].rsplit(".", 1)
+        return getattr(importlib.import_module(module_name), command_name)
 
 
-@click.group()
+@click.group(
+    cls=LazyGroup,
+    lazy_subcommands={
+        "validate": "loopsim.validate.validate",
+        "simulate": "loopsim.simulate.simulate",
+        "analyze": "loopsim.analyze.analyze",
+        "batch-analyze": "loopsim.batch_analyze.batch_analyze",
+        "sim-analyze": "loopsim.sim_analyze.sim_analyze",
+        "merge": "loopsim.merge.merge",
+        "visualize": "loopsim.visualize.visualize",
+    },
+)
 @click.option(
     "--delimiter",
     default="\t",
     type=str,
     help="delimiter for outputted files [default: tab]",
 )
+@click.option(
+    "--cache-dir",
+    type=click.Path(exists=False, file_okay=False, dir_okay=True, writable=True),
+    help="if passed, parsed input files are cached in this directory, so later commands reading the same unchanged files skip parsing them",
+)
+@click.option(
+    "--metrics-file",
+    type=click.Path(exists=False, file_okay=True, dir_okay=False, writable=True),
+    help="if passed, timings, worker throughput and peak memory are appended to this file as JSON lines",
+)
 @click.version_option(__version__)
-def cli(delimiter):
+@click.pass_context
+def cli(ctx, delimiter, cache_dir, metrics_file):
     """
     For a more thorough explanation of what every command does, please see the documentation or check an individual command's help text.
     """
     common.delimiter = delimiter
-
-
-cli.add_command(validate)
-cli.add_command(simulate)
-cli.add_command(analyze)
-cli.add_command(batch_analyze)
-cli.add_command(visualize)
+    common.cache_dir = cache_dir
+    metrics.metrics_file = metrics_file
+    metrics.start_run(ctx.invoked_subcommand)
+    ctx.call_on_close(metrics.finish_run)
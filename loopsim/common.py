@@ -1,11 +1,284 @@
 """stuff needed across modules in this package, but we don't want it to be at the module level"""
 
+import contextlib
+import gzip
+import hashlib
+import io
+import math
+import os
+import re
+import statistics
+import zipfile
+
+import click
+import numpy as np
+import pandas as pd
 from detect_delimiter import detect
 
+from . import metrics
+
 delimiter = ""  # this will be set by the main cli call
+cache_dir = None  # this will be set by the main cli call (None means parsed tables aren't cached)
+
+# Chromosome and coordinate columns of each kind of input file
+CHROMOSOME_COLUMNS = {"loop": (0, 3), "region": (0,), "intervals": (0,)}
+COORDINATE_COLUMNS = {"loop": (1, 2, 4, 5), "region": (1, 2), "intervals": (1, 2)}
+
+# Leading bytes of compressed input files
+COMPRESSION_MAGIC = {"gzip": b"\x1f\x8b", "zstd": b"\x28\xb5\x2f\xfd"}
+
+# Filename suffix of each output compression
+OUTPUT_COMPRESSIONS = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+# Suffix of a simulation file that is still being written (renamed once it is complete)
+PARTIAL_SUFFIX = ".tmp"
+
+# Number of rows read at a time when streaming a file (see read_chromosome_blocks)
+STREAM_CHUNK_ROWS = 1 << 20
+
+
+def get_settings():
+    """Settings from the main cli call, to hand to worker processes"""
+    return {"delimiter": delimiter, "cache_dir": cache_dir, "metrics_file": metrics.metrics_file, "metrics_run": metrics.run}
+
+
+def set_settings(settings):
+    """Apply settings from get_settings (e.g. in a worker process that didn't inherit them)"""
+    global delimiter, cache_dir
+    delimiter = settings["delimiter"]
+    cache_dir = settings["cache_dir"]
+    metrics.metrics_file = settings["metrics_file"]
+    metrics.run = settings["metrics_run"]
+
+
+def shard_sims(num_sims, shard_index, shard_count):
+    """Simulations run by shard shard_index of shard_count: a contiguous block of range(num_sims)
+
+    The blocks of all shards differ in size by at most one and together cover every simulation exactly once."""
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise click.UsageError(f"--shard-index must be between 0 and --shard-count - 1 (got {shard_index} of {shard_count})")
+    return range(num_sims * shard_index // shard_count, num_sims * (shard_index + 1) // shard_count)
+
+
+def wilson_interval(successes, n, confidence=0.95):
+    """Wilson score interval for a binomial proportion (e.g. an empirical p-value of successes / n)
+
+    Unlike the normal approximation, it stays inside [0, 1] and is still useful when there are no successes."""
+    z = statistics.NormalDist().inv_cdf(1 - (1 - confidence) / 2)
+    p = successes / n
+    denominator = 1 + z**2 / n
+    center = (p + z**2 / (2 * n)) / denominator
+    half_width = z * math.sqrt(p * (1 - p) / n + z**2 / (4 * n**2)) / denominator
+    # The bounds are exact at the ends, where rounding would otherwise leave them slightly off 0 or 1
+    lower = 0.0 if successes == 0 else max(0.0, center - half_width)
+    upper = 1.0 if successes == n else min(1.0, center + half_width)
+    return lower, upper
 
 
 def detect_delimiter(filename):
-    with open(filename) as f:
+    with open_text(filename) as f:
         firstline = f.readline()
-        return detect(firstline)
+    # detect never returns on an empty line
+    if not firstline.strip():
+        raise click.UsageError(f"{filename} is empty (or its first line is blank)")
+    return detect(firstline)
+
+
+def detect_compression(filename):
+    """Compression of a file ("gzip" or "zstd", going by its content rather than its name), or None if it is plain text"""
+    with open(filename, "rb") as f:
+        magic = f.read(4)
+    for compression, compression_magic in COMPRESSION_MAGIC.items():
+        if magic.startswith(compression_magic):
+            check_compression(compression)
+            return compression
+    return None
+
+
+def check_compression(compression):
+    """Raise a UsageError if the library needed for a compression isn't installed"""
+    if compression == "zstd":
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            raise click.UsageError("zstd compression needs the zstandard package (pip install loopsim[zstd])")
+
+
+def open_text(filename):
+    """Open a plain, gzip or zstd compressed file for reading text"""
+    compression = detect_compression(filename)
+    if compression == "gzip":
+        return gzip.open(filename, "rt")
+    if compression == "zstd":
+        import zstandard
+
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(filename, "rb"), closefd=True))
+    return open(filename)
+
+
+def list_loop_files(directory):
+    """Loop files in a directory, in natural sort order (see natural_sort_key)
+
+    Hidden files and the partial files of an unfinished 'simulate' (ending in PARTIAL_SUFFIX) are not loop files."""
+    filenames = (f for f in os.listdir(directory) if not f.startswith(".") and not f.endswith(PARTIAL_SUFFIX))
+    return sorted(filenames, key=natural_sort_key)
+
+
+def natural_sort_key(filename):
+    """Sort key that orders the numbers in filenames by value (sim_hi-c_2.loop before sim_hi-c_10.loop)"""
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", filename)]
+
+
+def file_sha256(filename):
+    """Hash of a file's content"""
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+@contextlib.contextmanager
+def open_output(filename, compression="none"):
+    """Open a text file for writing, compressed with one of OUTPUT_COMPRESSIONS
+
+    gzip files get no name or modification time in their header, so the same text always gives the same bytes."""
+    with open(filename, "wb") as f:
+        if compression == "gzip":
+            compressed = gzip.GzipFile(filename="", mode="wb", fileobj=f, compresslevel=6, mtime=0)
+        elif compression == "zstd":
+            import zstandard
+
+            compressed = zstandard.ZstdCompressor().stream_writer(f, closefd=False)
+        else:
+            compressed = f
+        with io.TextIOWrapper(compressed) as text:
+            yield text
+
+
+def read_table(filename, kind):
+    """Read a loop ("loop"), chromosome region ("region") or intervals ("intervals") file with compact dtypes
+
+    Files can be plain text or gzip/zstd compressed.
+
+    Chromosomes are categorical (with categories in order of appearance) and coordinates are int32 (int64 if they don't fit).
+    If cache_dir is set, the parsed table is cached there and reused for as long as the file's content and mtime are the same.
+    """
+    with metrics.timer("parse", file=filename, kind=kind, cached=False) as fields:
+        table = read_cached_table(filename, kind) if cache_dir is not None else None
+        if table is None:
+            table = parse_table(filename, kind)
+            if cache_dir is not None:
+                write_cached_table(filename, kind, table)
+        else:
+            fields["cached"] = True
+        fields["rows"] = len(table)
+    return table
+
+
+def cache_key(filename, kind):
+    return f"{kind}:{file_sha256(filename)}:{os.stat(filename).st_mtime_ns}"
+
+
+def cache_path(filename, kind):
+    return os.path.join(cache_dir, hashlib.sha256(f"{kind}:{os.path.abspath(filename)}".encode()).hexdigest() + ".npz")
+
+
+def read_cached_table(filename, kind):
+    """Parsed table from the cache, or None if it isn't cached (or the file changed since, or the entry can't be read)
+
+    Entries are plain arrays loaded without pickle, so an entry written by another version of pandas or numpy (or by
+    anyone else with access to a shared cache directory) is at worst a cache miss."""
+    try:
+        with np.load(cache_path(filename, kind)) as entry:
+            # Arrays are read lazily, so a stale entry is detected without reading its table
+            if str(entry["key"]) != cache_key(filename, kind):
+                return None
+            table = {}
+            for col in entry["columns"]:
+                if f"codes_{col}" in entry:
+                    table[col] = pd.Categorical.from_codes(entry[f"codes_{col}"], entry[f"categories_{col}"].astype(object))
+                else:
+                    table[col] = entry[f"values_{col}"]
+    except (OSError, KeyError, ValueError, TypeError, zipfile.BadZipFile):
+        return None
+    return pd.DataFrame(table)
+
+
+def write_cached_table(filename, kind, table):
+    """Cache a parsed table as category codes and categories for its chromosome columns and plain arrays for the others
+    (tables with text columns other than chromosomes aren't cached)"""
+    arrays = {"key": np.array(cache_key(filename, kind)), "columns": np.array(table.columns, dtype=np.int64)}
+    for col in table.columns:
+        if isinstance(table[col].dtype, pd.CategoricalDtype):
+            arrays[f"codes_{col}"] = table[col].cat.codes.to_numpy()
+            arrays[f"categories_{col}"] = np.array(table[col].cat.categories, dtype=str)
+        elif table[col].dtype.kind in "biuf":
+            arrays[f"values_{col}"] = table[col].to_numpy()
+        else:
+            return
+    cache_file = cache_path(filename, kind)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Written to a temporary file first, so concurrent readers never see a partial entry
+        with open(f"{cache_file}.{os.getpid()}.tmp", "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(f"{cache_file}.{os.getpid()}.tmp", cache_file)
+    except OSError as e:
+        print(f"WARNING: could not cache parsed {filename} in {cache_dir} ({e})", flush=True)
+
+
+def parse_table(filename, kind, **kwargs):
+    """Parse a loop, chromosome region or intervals file (see read_table)
+
+    Extra arguments go to pandas.read_table (with chunksize, this returns an iterator of compact chunks instead)"""
+    dtype = {col: str for col in CHROMOSOME_COLUMNS[kind]}
+    dtype.update({col: np.int64 for col in COORDINATE_COLUMNS[kind]})
+    table = pd.read_table(
+        filename,
+        header=None,
+        delimiter=detect_delimiter(filename),
+        dtype=dtype,
+        compression=detect_compression(filename),
+        **kwargs,
+    )
+    if "chunksize" in kwargs:
+        return (compact_table(chunk, kind) for chunk in table)
+    return compact_table(table, kind)
+
+
+def compact_table(table, kind):
+    """Make the chromosome columns of a parsed table categorical and its coordinates int32 where they fit"""
+    for col in CHROMOSOME_COLUMNS[kind]:
+        table[col] = pd.Categorical(table[col], categories=table[col].dropna().unique())
+    for col in COORDINATE_COLUMNS[kind]:
+        if len(table) and table[col].min() >= np.iinfo(np.int32).min and table[col].max() <= np.iinfo(np.int32).max:
+            table[col] = table[col].astype(np.int32)
+    return table
+
+
+def read_chromosome_blocks(filename, kind="loop"):
+    """Read a file one chromosome at a time, for files too big to hold in memory at once
+
+    The rows of each chromosome must be together in the file (as in the output of 'validate'). Yields (chromosome, table)
+    with the rows of one chromosome, indexed by their row number in the file, so at most one chromosome (plus one chunk of
+    STREAM_CHUNK_ROWS rows) is in memory at a time."""
+    seen = set()
+    pending = []
+    for chunk in parse_table(filename, kind, chunksize=STREAM_CHUNK_ROWS):
+        chrs = chunk[0].astype(str).to_numpy()
+        starts = np.concatenate([[0], np.flatnonzero(chrs[1:] != chrs[:-1]) + 1])
+        for start, end in zip(starts, np.append(starts[1:], len(chunk))):
+            chr = chrs[start]
+            if pending and chr != pending[0][0]:
+                yield pending[0][0], pd.concat([part for _, part in pending])
+                pending = []
+            if not pending:
+                if chr in seen:
+                    raise click.UsageError(
+                        f"the rows of chromosome {chr} are not together in {filename} (sort it with 'validate' first)"
+                    )
+                seen.add(chr)
+            pending.append((chr, chunk.iloc[start:end]))
+    if pending:
+        yield pending[0][0], pd.concat([part for _, part in pending])
@@ -0,0 +1,173 @@
+"""Merge the ratio distributions of a sharded run
+
+Sharded 'batch-analyze' and 'sim-analyze' runs write a provenance file (<distribution file>.json) next to each
+ratio distribution, recording which simulations its rows are and what it was computed from.
+"""
+
+import datetime
+import json
+import os
+
+import click
+import pandas as pd
+
+from loopsim import __version__
+
+from . import common, metrics
+
+
+@click.command()
+@click.argument(
+    "shard_distribution_files",
+    nargs=-1,
+    required=True,
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True),
+)
+@click.argument(
+    "overlapping_ratio_distribution_file", type=click.Path(exists=False, file_okay=True, dir_okay=False, writable=True)
+)
+def merge(shard_distribution_files, overlapping_ratio_distribution_file):
+    """Merge the ratio distributions of the shards of a run into one distribution
+
+    Every file in SHARD_DISTRIBUTION_FILES must have the provenance file that 'batch-analyze' or 'sim-analyze' writes next to it
+    when run with --shard-count. The shards must be from the same run (same command, inputs, number of simulations and seed),
+    and no simulation may be in more than one of them.
+
+    OVERLAPPING_RATIO_DISTRIBUTION_FILE gets the ratios in simulation order (ready for 'visualize'), and a provenance file
+    listing every merged shard.
+
+    NOTE: OVERLAPPING_RATIO_DISTRIBUTION_FILE may be overwritten!!"""
+
+    # Print params
+    for shard_distribution_file in shard_distribution_files:
+        print(f"Shard ratio distribution file: {shard_distribution_file}")
+    print(f"Ratio distribution file: {overlapping_ratio_distribution_file}")
+    print(f"Delimiter for output: '{common.delimiter}'")
+
+    # Get the shards and check that they belong together
+    shards = []
+    for shard_distribution_file in shard_distribution_files:
+        if not os.path.isfile(provenance_path(shard_distribution_file)):
+            raise click.UsageError(
+                f"{shard_distribution_file} has no provenance file ({provenance_path(shard_distribution_file)})"
+            )
+        provenance = read_provenance(shard_distribution_file)
+        ratios = read_distribution(shard_distribution_file)
+        sims = sims_from_ranges(provenance["sims"])
+        if len(ratios) != len(sims):
+            raise click.UsageError(
+                f"{shard_distribution_file} has {len(ratios)} ratios, but its provenance lists {len(sims)} simulations"
+            )
+        shards.append((shard_distribution_file, provenance, pd.Series(ratios.to_numpy(), index=sims)))
+
+    run = run_key(shards[0][1])
+    for shard_distribution_file, provenance, _ in shards[1:]:
+        if run_key(provenance) != run:
+            raise click.UsageError(f"{shard_distribution_file} is not from the same run as {shards[0][0]}")
+    if run["command"] == "batch-analyze" and run["seed"] is None and "first_loop_file" not in run["inputs"]:
+        print(
+            "WARNING: the provenance of these batch-analyze shards does not identify their simulations "
+            "(written by an older version, or from a binary store without a seed), so their loop inputs are not checked"
+        )
+
+    ratios = pd.concat([shard_ratios for _, _, shard_ratios in shards])
+    overlapping = ratios.index[ratios.index.duplicated()].unique()
+    if len(overlapping):
+        raise click.UsageError(f"{len(overlapping)} simulations are in more than one shard (e.g. simulation {overlapping[0]})")
+    ratios = ratios.sort_index()
+
+    # Warn about incomplete runs (the merged distribution is still written)
+    shard_count = shards[0][1]["shard_count"]
+    missing_shards = sorted(set(range(shard_count)) - {provenance["shard_index"] for _, provenance, _ in shards})
+    if missing_shards:
+        print(f"WARNING: shards {', '.join(map(str, missing_shards))} of {shard_count} were not passed")
+    num_missing = shards[0][1]["num_sims"] - len(ratios)
+    if num_missing:
+        print(f"WARNING: {num_missing} of {shards[0][1]['num_sims']} simulations are missing from the merged distribution")
+
+    # Output merged distribution and its provenance
+    with metrics.timer("write", file=overlapping_ratio_distribution_file):
+        ratios.to_csv(overlapping_ratio_distribution_file, header=None, index=None, sep=common.delimiter)
+    write_provenance(
+        overlapping_ratio_distribution_file,
+        {
+            **{key: value for key, value in shards[0][1].items() if key not in ("created", "shard_index", "sims")},
+            "sims": sims_to_ranges(ratios.index),
+            "shards": [{"file": shard_distribution_file, **provenance} for shard_distribution_file, provenance, _ in shards],
+        },
+    )
+    print(f"Merged {len(shards)} shards ({len(ratios)} simulations) into {overlapping_ratio_distribution_file}")
+
+
+def provenance_path(distribution_file):
+    """Path of the provenance file that goes with a ratio distribution file"""
+    return f"{distribution_file}.json"
+
+
+def make_provenance(command, sims, num_sims, shard_index, shard_count, inputs, seed=None, **fields):
+    """Provenance of a shard's ratio distribution
+
+    sims are the simulation numbers of the distribution's rows, inputs is {input name: path}
+    (files are recorded with their hash, so shards run on different machines can be compared)"""
+    return {
+        "loopsim_version": __version__,
+        "command": command,
+        "shard_index": shard_index,
+        "shard_count": shard_count,
+        "num_sims": num_sims,
+        "sims": sims_to_ranges(sims),
+        "seed": seed,
+        "inputs": {
+            name: {"path": path, "sha256": common.file_sha256(path) if os.path.isfile(path) else None}
+            for name, path in inputs.items()
+        },
+        **fields,
+    }
+
+
+def write_provenance(distribution_file, provenance):
+    provenance = {**provenance, "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")}
+    with open(provenance_path(distribution_file), "w") as f:
+        json.dump(provenance, f, indent=2)
+
+
+def read_provenance(distribution_file):
+    with open(provenance_path(distribution_file)) as f:
+        return json.load(f)
+
+
+def read_distribution(distribution_file):
+    """Ratios of a distribution file (exactly as written, so merging never changes a ratio)"""
+    if os.path.getsize(distribution_file) == 0:
+        return pd.Series([], dtype=float)
+    dist = pd.read_table(
+        distribution_file,
+        header=None,
+        delimiter=common.detect_delimiter(distribution_file),
+        compression=common.detect_compression(distribution_file),
+        float_precision="round_trip",
+    )
+    return dist[0]
+
+
+def run_key(provenance):
+    """What shards of the same run have in common (paths can differ between machines, so only file hashes are compared)"""
+    inputs = {name: source["sha256"] for name, source in provenance["inputs"].items()}
+    keys = ("command", "num_sims", "shard_count", "seed", "loop_files", "intervals_set")
+    return {**{key: provenance.get(key) for key in keys}, "inputs": inputs}
+
+
+def sims_to_ranges(sims):
+    """Compact [[start, stop], ...] form of a sequence of simulation numbers"""
+    ranges = []
+    for sim in sims:
+        sim = int(sim)
+        if ranges and ranges[-1][1] == sim:
+            ranges[-1][1] = sim + 1
+        else:
+            ranges.append([sim, sim + 1])
+    return ranges
+
+
+def sims_from_ranges(ranges):
+    return [sim for start, stop in ranges for sim in range(start, stop)]
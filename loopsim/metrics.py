@@ -0,0 +1,126 @@
+"""Timing and resource metrics
+
+If --metrics-file is passed, every process (including pool workers) appends one JSON object per line to it.
+Each event has the command's run id, the event name, its duration in seconds (if it is a timed stage),
+the process id and the peak RSS of the process so far. When the command finishes, a "worker" event with the
+throughput of each worker process and a "command" event with the total time and peak RSS are added.
+"""
+
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+import uuid
+
+import numpy as np
+
+metrics_file = None  # this will be set by the main cli call (None means no metrics are recorded)
+run = None  # this will be set by start_run
+
+
+def start_run(command):
+    """Start recording metrics for a command (called by the main cli call)"""
+    global run
+    run = {"id": uuid.uuid4().hex, "command": command, "start": time.time(), "offset": metrics_file_size()}
+
+
+def metrics_file_size():
+    """Where the events of a run that starts now will begin in the metrics file"""
+    try:
+        return os.path.getsize(metrics_file) if metrics_file is not None else 0
+    except OSError:
+        return 0
+
+
+def enabled():
+    return metrics_file is not None and run is not None
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """Peak resident set size (ru_maxrss is in KB on Linux, but in bytes on macOS)"""
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def record(event, **fields):
+    """Append an event to the metrics file"""
+    if not enabled():
+        return
+    line = json.dumps(
+        {
+            "run": run["id"],
+            "command": run["command"],
+            "event": event,
+            "time": time.time(),
+            "pid": os.getpid(),
+            "peak_rss_mb": peak_rss_mb(),
+            **fields,
+        },
+        default=json_default,
+    )
+    # A single O_APPEND write keeps lines from different processes from interleaving
+    fd = os.open(metrics_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (line + "\n").encode())
+    finally:
+        os.close(fd)
+
+
+def json_default(value):
+    """JSON form of field values that json can't serialize itself (numpy scalars are a common one)"""
+    return value.item() if isinstance(value, np.generic) else str(value)
+
+
+@contextlib.contextmanager
+def timer(event, **fields):
+    """Record how long the body takes (fields can be added to while it runs)"""
+    start = time.perf_counter()
+    yield fields
+    record(event, seconds=time.perf_counter() - start, **fields)
+
+
+def run_events():
+    """Events recorded so far in this run (the file doesn't exist yet if nothing was recorded)"""
+    try:
+        with open(metrics_file, "rb") as f:
+            f.seek(run["offset"])
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                if event.get("run") == run["id"]:
+                    yield event
+    except FileNotFoundError:
+        return
+
+
+def finish_run():
+    """Summarize worker throughput from the task events of this run and record the command's totals
+
+    The metrics file can be shared by many commands, so only the events appended since start_run are read."""
+    if not enabled():
+        return
+    workers = {}
+    for event in run_events():
+        if not event.get("task"):
+            continue
+        worker = workers.setdefault(event["pid"], {"tasks": 0, "busy_seconds": 0.0, "peak_rss_mb": 0.0})
+        worker["tasks"] += 1
+        worker["busy_seconds"] += event["seconds"]
+        worker["peak_rss_mb"] = max(worker["peak_rss_mb"], event["peak_rss_mb"])
+    for pid, worker in sorted(workers.items()):
+        record(
+            "worker",
+            worker_pid=pid,
+            tasks_per_second=worker["tasks"] / worker["busy_seconds"] if worker["busy_seconds"] else None,
+            **worker,
+        )
+    record(
+        "command",
+        seconds=time.time() - run["start"],
+        num_workers=len(workers),
+        peak_rss_children_mb=peak_rss_mb(resource.RUSAGE_CHILDREN),
+    )
@@ -0,0 +1,81 @@
+"""Placement of simulated loops outside of excluded regions (e.g. assembly gaps, centromeres or blacklisted regions)
+
+The allowed part of a chromosome is split into segments. A loop spanning `span` bases can start anywhere in a segment
+of length L > span, in L - span positions. Keeping the segments sorted by length with cumulative lengths, the
+total number of valid starts for any span and the segment holding the u-th valid start are found by binary search,
+so a random start is drawn in O(log n) without rejection sampling.
+"""
+
+import numpy as np
+
+
+class PlacementIndex:
+    """Allowed segments of one chromosome, for drawing random loop starts
+
+    A loop starting at `start` and spanning `span` bases is allowed if [start, start + span] lies within [1, chromosome_length)
+    and overlaps none of the excluded regions (half-open [start, end) like in a BED file)."""
+
+    def __init__(self, chromosome_length, excluded_starts=(), excluded_ends=()):
+        # Merge the excluded regions and take the gaps between them
+        excluded_starts = np.asarray(excluded_starts, dtype=np.int64)
+        excluded_ends = np.asarray(excluded_ends, dtype=np.int64)
+        order = np.argsort(excluded_starts, kind="stable")
+        excluded_starts = excluded_starts[order]
+        excluded_ends = np.maximum.accumulate(excluded_ends[order]) if len(order) else excluded_ends
+        segment_starts = np.concatenate([[1], excluded_ends])
+        segment_ends = np.concatenate([excluded_starts, [chromosome_length]])
+        segment_starts = np.clip(segment_starts, 1, chromosome_length)
+        segment_ends = np.clip(segment_ends, 1, chromosome_length)
+        # Between merged regions, an excluded region can start before the previous one ended, leaving an empty segment
+        keep = segment_ends > segment_starts
+        self.starts = segment_starts[keep]
+        self.ends = segment_ends[keep]
+
+        # Longest segments first, so the segments that can hold a loop of any span are always a prefix
+        by_length = np.argsort(self.starts - self.ends, kind="stable")
+        self.by_length_starts = self.starts[by_length]
+        self.by_length_lengths = (self.ends - self.starts)[by_length]
+        self.cumulative_lengths = np.concatenate([[0], np.cumsum(self.by_length_lengths)])
+
+    def num_starts(self, span):
+        """Number of (segments that can hold a loop spanning span bases, valid starts for it)"""
+        num_segments = int(np.searchsorted(-self.by_length_lengths, -span, side="left"))
+        return num_segments, int(self.cumulative_lengths[num_segments]) - num_segments * span
+
+    def random_start(self, span, rng):
+        """Draw a uniformly random start among all the allowed starts of a loop spanning span bases"""
+        num_segments, num_starts = self.num_starts(span)
+        if num_starts <= 0:
+            raise ValueError(f"a loop spanning {span} bases does not fit in any allowed segment")
+        u = int(rng.integers(num_starts))
+
+        # The first k segments have cumulative_lengths[k] - k * span valid starts, which grows with k
+        lo, hi = 0, num_segments - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.cumulative_lengths[mid] - mid * span <= u:
+                lo = mid
+            else:
+                hi = mid - 1
+        return int(self.by_length_starts[lo]) + u - (int(self.cumulative_lengths[lo]) - lo * span)
+
+    def fits(self, starts, spans):
+        """Which of the loops starting at starts and spanning spans bases are allowed"""
+        segment = np.searchsorted(self.starts, starts, side="right") - 1
+        return (segment >= 0) & (starts + spans < self.ends[np.maximum(segment, 0)])
+
+    def longest_segment(self):
+        return int(self.by_length_lengths[0]) if len(self.by_length_lengths) else 0
+
+
+def placement_indexes(chromosomes, chromosome_lengths, excluded):
+    """PlacementIndex of each chromosome, excluding the regions in the excluded table (chromosome, start, end)"""
+    excluded_by_chr = {str(chr): excluded_chr for chr, excluded_chr in excluded.groupby(0, sort=False, observed=True)}
+    indexes = []
+    for chr, chromosome_length in zip(chromosomes, chromosome_lengths):
+        excluded_chr = excluded_by_chr.get(str(chr))
+        if excluded_chr is None:
+            indexes.append(PlacementIndex(chromosome_length))
+        else:
+            indexes.append(PlacementIndex(chromosome_length, excluded_chr[1].to_numpy(), excluded_chr[2].to_numpy()))
+    return indexes
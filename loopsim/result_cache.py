@@ -0,0 +1,73 @@
+"""Persistent cache of batch analysis results
+
+Each entry holds the result of analyzing one loop file (or one simulation in a binary store) against one intervals file:
+its number of loops, its ratio and its sparse overlaps (see analyze.find_overlap_pairs). Entries are named after the hashes
+of both inputs' content, so renamed or moved files are still found, and a changed file is simply a new entry.
+
+Reading an entry marks it as recently used (by touching its file), and evict() removes the least recently used entries
+once the cache is bigger than its maximum size.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+# Part of every key, so entries written in an older layout are never read back
+RESULT_CACHE_VERSION = 1
+
+
+class ResultCache:
+    """Result cache in directory, holding at most max_bytes of entries after each evict()"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, loop_sha256, intervals_sha256):
+        key = hashlib.sha256(f"{RESULT_CACHE_VERSION}:{loop_sha256}:{intervals_sha256}".encode()).hexdigest()
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def get(self, loop_sha256, intervals_sha256):
+        """(number of loops, ratio, (loop rows, interval rows)) of a cached result, or None if it isn't cached"""
+        path = self.path(loop_sha256, intervals_sha256)
+        try:
+            with np.load(path) as entry:
+                result = int(entry["num_loops"]), float(entry["ratio"]), (entry["loops"], entry["intervals"])
+            os.utime(path)
+        except (OSError, KeyError, ValueError):
+            return None
+        return result
+
+    def put(self, loop_sha256, intervals_sha256, num_loops, ratio, pairs):
+        """Cache a result (written to a temporary file first, so concurrent readers never see a partial entry)"""
+        path = self.path(loop_sha256, intervals_sha256)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(f"{path}.{os.getpid()}.tmp", "wb") as f:
+                np.savez(f, num_loops=num_loops, ratio=ratio, loops=pairs[0], intervals=pairs[1])
+            os.replace(f"{path}.{os.getpid()}.tmp", path)
+        except OSError as e:
+            print(f"WARNING: could not cache result in {self.directory} ({e})", flush=True)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in max_bytes, and return how many were removed"""
+        if not os.path.isdir(self.directory):
+            return 0
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npz"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total_bytes = sum(size for _, size, _ in entries)
+        num_evicted = 0
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+            num_evicted += 1
+        return num_evicted
@@ -0,0 +1,248 @@
+"""Fused loop simulation and analysis"""
+
+import multiprocessing as mp
+import tempfile
+
+import click
+import numpy as np
+
+from . import common, metrics
+from .analyze import IntervalsIndex, find_overlap_pairs, overlap_ratio
+from .merge import make_provenance, write_provenance
+from .simulate import LoopArrays, run_sim_coords
+
+# Inputs shared by every task in a worker process (set by init_worker)
+_worker = {}
+
+
+@click.command()
+@click.argument("loop_in_file", type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True))
+@click.argument("chromosome_region_file", type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True))
+@click.argument("intervals_file", type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True))
+@click.argument(
+    "overlapping_ratio_distribution_file", type=click.Path(exists=False, file_okay=True, dir_okay=False, writable=True)
+)
+@click.option("--num-sims", show_default=True, default=1, type=int, help="number of simulations")
+@click.option(
+    "--num-processes",
+    type=int,
+    help="number of threads to use                          [default: max(1, round(multiprocessing.cpu_count() / 2))]",
+)
+@click.option(
+    "--loop-hits-file",
+    type=click.Path(exists=False, file_okay=True, dir_okay=False, writable=True),
+    help="if passed, will output LOOP_IN_FILE with an extra column counting the simulations in which each loop overlapped an interval of interest",
+)
+@click.option(
+    "--seed",
+    type=int,
+    help="seed for the random placement of loops (the same seed always gives the same simulations)  [default: random]",
+)
+@click.option(
+    "--exclude-file",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True),
+    help="BED file (chromosome, start, end) of regions that simulated loops must not be placed in (e.g. gaps or blacklisted regions)",
+)
+@click.option(
+    "--shard-index", show_default=True, default=0, type=int, help="which shard of the simulations to run (0 to --shard-count - 1)"
+)
+@click.option(
+    "--shard-count",
+    show_default=True,
+    default=1,
+    type=int,
+    help="split the --num-sims simulations into this many shards that can be run independently (combine their outputs with 'merge')",
+)
+@click.option(
+    "--observed-ratio",
+    type=float,
+    help="if passed, simulations are run in batches until the empirical p-value of this ratio (e.g. from 'analyze') is known well enough "
+    "(--num-sims is then the maximum number of simulations)",
+)
+@click.option("--batch-size", show_default=True, default=100, type=int, help="number of simulations between stopping checks")
+@click.option(
+    "--alpha",
+    show_default=True,
+    default=0.05,
+    type=float,
+    help="significance threshold: stop once the confidence interval of the p-value is entirely below or above it",
+)
+@click.option(
+    "--ci-width",
+    show_default=True,
+    default=0.01,
+    type=float,
+    help="stop once the confidence interval of the p-value is narrower than this",
+)
+@click.option("--confidence", show_default=True, default=0.95, type=float, help="confidence level of the p-value's interval")
+def sim_analyze(
+    loop_in_file,
+    chromosome_region_file,
+    intervals_file,
+    overlapping_ratio_distribution_file,
+    num_sims,
+    num_processes,
+    loop_hits_file,
+    seed,
+    exclude_file,
+    shard_index,
+    shard_count,
+    observed_ratio,
+    batch_size,
+    alpha,
+    ci_width,
+    confidence,
+):
+    """Generate a distribution of simulations and analyze them on the fly
+
+    This is like running 'simulate' followed by 'batch-analyze', except the simulated loop files are never written to disk.
+    Each simulation's ratio is written to OVERLAPPING_RATIO_DISTRIBUTION_FILE as soon as it is ready.
+
+    With --shard-count, only the simulations of shard --shard-index are run (the same ones 'simulate' would run for that shard),
+    and a provenance file is written next to OVERLAPPING_RATIO_DISTRIBUTION_FILE so the shards can be combined with 'merge'.
+
+    With --observed-ratio, simulations are run --batch-size at a time. After each batch, the empirical p-value of the observed ratio
+    (the fraction of simulated ratios above it, like in 'visualize') gets a Wilson confidence interval, and the run stops early
+    once that interval is narrower than --ci-width or lies entirely on one side of --alpha.
+
+    NOTE: OVERLAPPING_RATIO_DISTRIBUTION_FILE may be overwritten!!"""
+    # Set number of processes if not passed in by user
+    if num_processes is None:
+        num_processes = max(1, round(mp.cpu_count() / 2))
+
+    sims = common.shard_sims(num_sims, shard_index, shard_count)
+    if shard_count > 1 and seed is None:
+        raise click.UsageError("--seed must be passed with --shard-count, so that every shard belongs to the same run")
+    if shard_count > 1 and observed_ratio is not None:
+        raise click.UsageError("--observed-ratio cannot be used with --shard-count (each shard would stop at a different point)")
+    if batch_size < 1:
+        raise click.UsageError("--batch-size must be at least 1")
+
+    # Pick a seed if not passed in by user (and print it below so the run can be reproduced)
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+
+    # Print params
+    print(f"Input loop file: {loop_in_file}", flush=True)
+    print(f"Chromosome regions file: {chromosome_region_file}", flush=True)
+    print(f"Intervals file: {intervals_file}", flush=True)
+    print(f"Ratio distribution file: {overlapping_ratio_distribution_file}", flush=True)
+    print(f"Number of simulations: {num_sims}", flush=True)
+    if shard_count > 1:
+        print(f"Shard: {shard_index} of {shard_count} (simulations {sims.start} to {sims.stop - 1})", flush=True)
+    print(f"Number of processes: {num_processes}", flush=True)
+    print(f"Seed: {seed}", flush=True)
+    if exclude_file is not None:
+        print(f"Excluded regions file: {exclude_file}", flush=True)
+    if observed_ratio is not None:
+        print(f"Observed ratio: {observed_ratio}", flush=True)
+        print(f"Stopping when the {confidence:.0%} interval of the p-value is < {ci_width} wide or excludes {alpha}", flush=True)
+    print(f"Delimiter for output: '{common.delimiter}'", flush=True)
+    if loop_hits_file:
+        print(f"Loop hits file: {loop_hits_file}", flush=True)
+
+    # Read in loop data
+    loop_in = common.read_table(loop_in_file, "loop")
+
+    # Read in chromosome regions
+    chr_rg = common.read_table(chromosome_region_file, "region")
+
+    # Get intervals
+    intervals = common.read_table(intervals_file, "intervals")
+    intervals_index = IntervalsIndex(intervals)
+
+    # Read in excluded regions
+    excluded = common.read_table(exclude_file, "intervals") if exclude_file is not None else None
+
+    # Simulated loops come out grouped by chromosome, so keep track of which input row each one stands in for
+    # (the loops are split by chromosome once for all simulations)
+    loop_arrays = LoopArrays.from_tables(loop_in, chr_rg, excluded)
+    loop_hits = np.zeros(len(loop_in), dtype=np.int64)
+
+    # Without --observed-ratio, all simulations are one batch
+    if observed_ratio is None:
+        sim_batches = [sims]
+    else:
+        sim_batches = [sims[start : start + batch_size] for start in range(0, len(sims), batch_size)]
+    num_done = num_larger = 0
+
+    # Multiprocessing
+    with tempfile.TemporaryDirectory() as shared_directory, mp.Pool(
+        num_processes,
+        initializer=init_worker,
+        initargs=(loop_arrays.share(shared_directory), intervals_index, seed, bool(loop_hits_file), common.get_settings()),
+    ) as pool, open(overlapping_ratio_distribution_file, "w") as dist_out:
+        for sim_batch in sim_batches:
+            for ratio, hits in pool.imap(sim_and_analyze, sim_batch):
+                dist_out.write(f"{ratio}\n")
+                dist_out.flush()
+                if loop_hits_file:
+                    loop_hits[loop_arrays.rows] += hits
+                num_done += 1
+                num_larger += observed_ratio is not None and ratio > observed_ratio
+            if observed_ratio is not None and stop_early(num_larger, num_done, alpha, ci_width, confidence):
+                break
+        print(f"Simulation processing complete! ({num_done} simulations)", flush=True)
+        pool.close()
+        pool.join()
+        print("Multiprocessing pool closed", flush=True)
+    print(f"Finished outputting ratio distribution to {overlapping_ratio_distribution_file}", flush=True)
+    if shard_count > 1:
+        inputs = {
+            "loop_in_file": loop_in_file,
+            "chromosome_region_file": chromosome_region_file,
+            "intervals_file": intervals_file,
+        }
+        if exclude_file is not None:
+            inputs["exclude_file"] = exclude_file
+        provenance = make_provenance("sim-analyze", sims, num_sims, shard_index, shard_count, inputs, seed=seed)
+        write_provenance(overlapping_ratio_distribution_file, provenance)
+
+    # Output hit counts
+    if loop_hits_file:
+        loop_in[6] = loop_hits
+        with metrics.timer("write", file=loop_hits_file):
+            loop_in.to_csv(loop_hits_file, header=None, index=None, sep=common.delimiter)
+        print(f"Finished outputting loop hits to {loop_hits_file}", flush=True)
+
+
+def stop_early(num_larger, num_done, alpha, ci_width, confidence):
+    """Print the p-value so far and decide whether it is known well enough to stop simulating"""
+    lower, upper = common.wilson_interval(num_larger, num_done, confidence)
+    print(
+        f"After {num_done} simulations: p-value {num_larger / num_done} ({confidence:.0%} interval [{lower}, {upper}])",
+        flush=True,
+    )
+    metrics.record("adaptive_check", sims=num_done, num_larger=num_larger, ci_lower=lower, ci_upper=upper)
+    if upper < alpha:
+        print(f"Stopping early: the p-value is below {alpha}", flush=True)
+    elif lower > alpha:
+        print(f"Stopping early: the p-value is above {alpha}", flush=True)
+    elif upper - lower < ci_width:
+        print(f"Stopping early: the interval of the p-value is narrower than {ci_width}", flush=True)
+    else:
+        return False
+    return True
+
+
+def init_worker(loop_arrays, intervals_index, seed, keep_hits, settings):
+    """Store the inputs once per worker process instead of sending them with every task"""
+    common.set_settings(settings)
+    _worker["loop_arrays"] = loop_arrays
+    _worker["intervals_index"] = intervals_index
+    _worker["seed"] = seed
+    _worker["keep_hits"] = keep_hits
+
+
+def sim_and_analyze(sim_name):
+    """Run one simulation and reduce it to its overlapping ratio (and which simulated loops overlapped)"""
+    loop_arrays = _worker["loop_arrays"]
+    with metrics.timer("sim_analyze_task", task=True, sim=sim_name):
+        coords = run_sim_coords(loop_arrays, sim_name, _worker["seed"])
+        with metrics.timer("analyze", sim=sim_name):
+            (pairs,) = find_overlap_pairs(loop_arrays.loop_blocks(coords), [_worker["intervals_index"]])
+        hits = None
+        if _worker["keep_hits"]:
+            hits = np.zeros(loop_arrays.num_loops, dtype=bool)
+            hits[pairs[0]] = True
+    return overlap_ratio(pairs, loop_arrays.num_loops), hits
@@ -1,13 +1,23 @@
 """loop simulation"""
 
+import contextlib
 import multiprocessing as mp
 import os
+import tempfile
 
 import click
 import numpy as np
 import pandas as pd
 
-from . import common
+from . import common, metrics
+from .placement import placement_indexes
+from .store import SimulationStore, create_store, is_store, store_path
+
+# Inputs shared by every task in a worker process (set by init_worker)
+_worker = {}
+
+# Raw int64 file that LoopArrays.share writes the loop coordinates to
+SHARED_COORDS_FILENAME = "loop_arrays.bin"
 
 
 @click.command()
@@ -18,15 +28,101 @@ from . import common
 @click.option(
     "--num-processes",
     type=int,
-    help="number of threads to use                          [default: round(multiprocessing.cpu_count() / 2)]",
+    help="number of threads to use                          [default: max(1, round(multiprocessing.cpu_count() / 2))]",
+)
+@click.option(
+    "--output-format",
+    show_default=True,
+    default="text",
+    type=click.Choice(["text", "npy"]),
+    help="'text' outputs one loop file per simulation, 'npy' outputs all simulations to a single binary store (sim_hi-c.npy)",
+)
+@click.option(
+    "--compression",
+    show_default=True,
+    default="none",
+    type=click.Choice(list(common.OUTPUT_COMPRESSIONS)),
+    help="compression of text simulation files (sim_hi-c_0.loop.gz with gzip, sim_hi-c_0.loop.zst with zstd)",
+)
+@click.option(
+    "--seed",
+    type=int,
+    help="seed for the random placement of loops (the same seed always gives the same simulations)  [default: random]",
+)
+@click.option(
+    "--exclude-file",
+    type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True),
+    help="BED file (chromosome, start, end) of regions that simulated loops must not be placed in (e.g. gaps or blacklisted regions)",
+)
+@click.option(
+    "--streaming",
+    is_flag=True,
+    help="read LOOP_IN_FILE one chromosome at a time, for loop files too big to load at once (the rows of each chromosome "
+    "must be together, as in the output of 'validate')",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="only run the simulations that are not already in SIMULATION_DATA_DIRECTORY (pass the same --seed as the original run)",
+)
+@click.option(
+    "--shard-index", show_default=True, default=0, type=int, help="which shard of the simulations to run (0 to --shard-count - 1)"
+)
+@click.option(
+    "--shard-count",
+    show_default=True,
+    default=1,
+    type=int,
+    help="split the --num-sims simulations into this many shards that can be run independently (e.g. one per node)",
 )
-def simulate(loop_in_file, chromosome_region_file, simulation_data_directory, num_sims, num_processes):
+def simulate(
+    loop_in_file,
+    chromosome_region_file,
+    simulation_data_directory,
+    num_sims,
+    num_processes,
+    output_format,
+    compression,
+    seed,
+    exclude_file,
+    streaming,
+    resume,
+    shard_index,
+    shard_count,
+):
     """Generate a distribution of simulations
 
+    With --output-format npy, the simulations are stored as integer coordinates in SIMULATION_DATA_DIRECTORY/sim_hi-c.npy
+    (plus a chromosome table in sim_hi-c_chr.npz), which 'analyze' and 'batch-analyze' read directly.
+
+    Every simulation (and every chromosome within it) gets its own random stream derived from --seed,
+    so a simulation's output does not depend on --num-processes or on which other simulations are run.
+
+    With --shard-count, only the simulations of shard --shard-index are run. The shards of a run (same --num-sims and --seed)
+    get non-overlapping simulation numbers, and together produce exactly the simulations of the unsharded run.
+    Text output can go to one shared directory; with --output-format npy, each shard needs its own directory.
+
+    With --compression, every worker process compresses the simulations it writes, so compression runs in parallel.
+
+    Simulations are written one chromosome at a time. With --streaming, the loop file is also read one chromosome at a time
+    and its coordinates go straight to a file shared by the workers, so memory use depends on the largest chromosome
+    rather than the whole loop file.
+
     NOTE: any data in SIMULATION_DATA_DIRECTORY may be overwritten!!"""
     # Set number of processes if not passed in by user
     if num_processes is None:
-        num_processes = round(mp.cpu_count() / 2)
+        num_processes = max(1, round(mp.cpu_count() / 2))
+
+    sims = common.shard_sims(num_sims, shard_index, shard_count)
+    if shard_count > 1 and seed is None:
+        raise click.UsageError("--seed must be passed with --shard-count, so that every shard belongs to the same run")
+    if compression != "none" and output_format != "text":
+        raise click.UsageError("--compression only applies to --output-format text")
+    common.check_compression(compression)
+
+    # Pick a seed if not passed in by user (and print it below so the run can be reproduced)
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
 
     # Get data dir sorted out
     if not os.path.isdir(simulation_data_directory):
@@ -38,118 +134,385 @@ def simulate(loop_in_file, chromosome_region_file, simulation_data_directory, nu
     print(f"Input loop file: {loop_in_file}", flush=True)
     print(f"Chromosome regions file: {chromosome_region_file}", flush=True)
     print(f"Number of simulations: {num_sims}", flush=True)
+    if shard_count > 1:
+        print(f"Shard: {shard_index} of {shard_count} (simulations {sims.start} to {sims.stop - 1})", flush=True)
     print(f"Number of processes: {num_processes}", flush=True)
     print(f"Outputting simulation files to directory: {simulation_data_directory}", flush=True)
+    print(f"Output format: {output_format}", flush=True)
+    if compression != "none":
+        print(f"Compression: {compression}", flush=True)
+    print(f"Seed: {seed}", flush=True)
+    if exclude_file is not None:
+        print(f"Excluded regions file: {exclude_file}", flush=True)
+    if streaming:
+        print("Streaming: reading the loop file one chromosome at a time", flush=True)
     print(f"Delimiter for output: '{common.delimiter}'", flush=True)
 
-    # Read in loop data
-    loop_in = pd.read_table(loop_in_file, header=None, delimiter=common.detect_delimiter(loop_in_file))
-
     # Read in chromosome regions
-    chr_rg = pd.read_table(chromosome_region_file, header=None, delimiter=common.detect_delimiter(chromosome_region_file))
+    chr_rg = common.read_table(chromosome_region_file, "region")
+
+    # Read in excluded regions
+    excluded = common.read_table(exclude_file, "intervals") if exclude_file is not None else None
+
+    with tempfile.TemporaryDirectory() as shared_directory:
+        # Read in loop data and split the loops by chromosome once for all simulations
+        # (shared with the workers through a memory-mapped file in shared_directory)
+        if streaming:
+            loop_blocks = common.read_chromosome_blocks(loop_in_file, "loop")
+            loop_arrays = LoopArrays.from_chromosome_blocks(loop_blocks, chr_rg, excluded, directory=shared_directory)
+        else:
+            loop_in = common.read_table(loop_in_file, "loop")
+            loop_arrays = LoopArrays.from_tables(loop_in, chr_rg, excluded).share(shared_directory)
+        run_sims(
+            loop_arrays,
+            simulation_data_directory,
+            sims,
+            num_sims,
+            num_processes,
+            output_format,
+            compression,
+            seed,
+            resume,
+            shard_index,
+            shard_count,
+        )
+
+
+def run_sims(
+    loop_arrays,
+    simulation_data_directory,
+    sims,
+    num_sims,
+    num_processes,
+    output_format,
+    compression,
+    seed,
+    resume,
+    shard_index,
+    shard_count,
+):
+    """Run the simulations of a shard in a pool of workers and output them to the simulation data directory"""
+    # Find the simulations that are already done
+    completed_sims = (
+        find_completed_sims(simulation_data_directory, sims, output_format, compression, loop_arrays.num_loops) if resume else []
+    )
+    if resume:
+        print(f"Resuming: {len(completed_sims)} of {len(sims)} simulations already in {simulation_data_directory}", flush=True)
+
+    # Set up the binary store (its chromosome blocks are in the same order that run_sim outputs them)
+    if output_format == "npy" and not (resume and is_store(simulation_data_directory)):
+        create_store(
+            store_path(simulation_data_directory),
+            num_sims,
+            loop_arrays.chromosomes,
+            np.diff(loop_arrays.offsets),
+            loop_arrays.chromosome_lengths.max(),
+            shard_index=shard_index,
+            shard_count=shard_count,
+            seed=seed,
+        )
 
     # Multiprocessing
-    sim_names = range(num_sims)
-    with mp.Pool(num_processes) as pool:
-        completed_sims = pool.starmap(run_sim, [(loop_in, chr_rg, sim_name) for sim_name in sim_names])
+    # Each worker writes its simulations out as soon as they finish, so only the in-flight simulations are held in memory
+    sim_names = sorted(set(sims) - set(completed_sims))
+    with mp.Pool(
+        num_processes,
+        initializer=init_worker,
+        initargs=(
+            loop_arrays,
+            simulation_data_directory,
+            output_format,
+            compression,
+            seed,
+            common.get_settings(),
+        ),
+    ) as pool:
+        for sim_name, output_filepath in pool.imap_unordered(run_sim_to_file, sim_names):
+            print(f"Simulation {sim_name} data outputted to file: {output_filepath}", flush=True)
         print("Simulation processing complete!", flush=True)
         pool.close()
         pool.join()
         print("Multiprocessing pool closed", flush=True)
 
-    # Output simulated loop data to files
-    for sim, sim_name in zip(completed_sims, sim_names):
-        output_filepath = f"{simulation_data_directory}/sim_hi-c_{sim_name}.loop"
-        sim.to_csv(output_filepath, header=None, index=None, sep=common.delimiter)
-        print(f"Simulation {sim_name} data outputted to file: {output_filepath}", flush=True)
+
+def find_completed_sims(simulation_data_directory, sims, output_format, compression, num_loops):
+    """Which of the simulations in sims are already in the simulation data directory?"""
+    if output_format == "npy":
+        if not is_store(simulation_data_directory):
+            return []
+        store = SimulationStore(simulation_data_directory)
+        if store.sims != sims or store.num_loops != num_loops:
+            raise click.UsageError(
+                f"Cannot resume: the store in {simulation_data_directory} holds simulations {store.sims.start} to "
+                f"{store.sims.stop - 1} of {store.num_loops} loops"
+            )
+        return list(store.completed_sims())
+    suffix = common.OUTPUT_COMPRESSIONS[compression]
+    return [sim_name for sim_name in sims if os.path.isfile(f"{simulation_data_directory}/sim_hi-c_{sim_name}.loop{suffix}")]
+
+
+def init_worker(loop_arrays, simulation_data_directory, output_format, compression, seed, settings):
+    """Store the inputs once per worker process instead of sending them with every task (so tasks are just simulation numbers)"""
+    common.set_settings(settings)
+    _worker["loop_arrays"] = loop_arrays
+    _worker["simulation_data_directory"] = simulation_data_directory
+    _worker["compression"] = compression
+    _worker["seed"] = seed
+    _worker["store"] = SimulationStore(simulation_data_directory, mode="r+") if output_format == "npy" else None
 
 
-def run_sim(loop_in, chr_rg, sim_name):
-    """Run simulation on all chromosomes"""
+def run_sim_to_file(sim_name):
+    """Run a simulation and output it to its file in the simulation data directory (or to its slot in the binary store)
+
+    Each chromosome is written out as soon as it is simulated, so a worker never holds more than one chromosome of output."""
+    loop_arrays = _worker["loop_arrays"]
+    store = _worker["store"]
+    with metrics.timer("simulate_task", task=True, sim=sim_name):
+        if store is not None:
+            output_filepath = store.path
+            for chr, rows, coords in run_sim_blocks(loop_arrays, sim_name, _worker["seed"]):
+                with metrics.timer("write", file=output_filepath, sim=sim_name, chromosome=chr):
+                    store.write_rows(sim_name, rows, coords)
+            store.mark_done(sim_name)
+        else:
+            # Write to a temporary file first so an interrupted run never leaves a truncated simulation behind for --resume
+            output_filepath = f"{_worker['simulation_data_directory']}/sim_hi-c_{sim_name}.loop{common.OUTPUT_COMPRESSIONS[_worker['compression']]}"
+            with common.open_output(f"{output_filepath}{common.PARTIAL_SUFFIX}", _worker["compression"]) as f:
+                for chr, rows, coords in run_sim_blocks(loop_arrays, sim_name, _worker["seed"]):
+                    with metrics.timer("write", file=output_filepath, sim=sim_name, chromosome=chr):
+                        chromosome_dataframe(chr, coords).to_csv(f, header=None, index=None, sep=common.delimiter)
+            os.replace(f"{output_filepath}{common.PARTIAL_SUFFIX}", output_filepath)
+    return sim_name, output_filepath
+
+
+def run_sim(loop_in, chr_rg, sim_name, seed=None, excluded=None):
+    """Run simulation on all chromosomes
+
+    Each chromosome gets an independent random stream spawned from (seed, sim_name, chromosome number),
+    so the simulation is reproducible given the seed (and unseeded simulations are independent across processes)"""
+    loop_arrays = LoopArrays.from_tables(loop_in, chr_rg, excluded)
+    return loop_arrays.to_dataframe(run_sim_coords(loop_arrays, sim_name, seed))
+
+
+def run_sim_coords(loop_arrays, sim_name, seed=None):
+    """Same as run_sim, but on loops that are already split by chromosome (see LoopArrays)
+
+    Returns the simulated (loops, 4) coordinates, laid out like LoopArrays.coords"""
+    coords_out = np.empty((loop_arrays.num_loops, 4), dtype=np.int64)
+    for _, rows, coords in run_sim_blocks(loop_arrays, sim_name, seed):
+        coords_out[rows] = coords
+    return coords_out
+
+
+def run_sim_blocks(loop_arrays, sim_name, seed=None):
+    """Same as run_sim_coords, but one chromosome at a time
+
+    Yields (chromosome, rows of its block in LoopArrays.coords, simulated (loops, 4) coordinates of its block)"""
     print(f"Simulation {sim_name} simulation started", flush=True)
-    loop_out = split_by_chr(loop_in).apply(sim_chromosome, chr_rg=chr_rg)
+    for i, (chr, rows, chromosome_length) in enumerate(loop_arrays.chromosome_blocks()):
+        with metrics.timer("simulate_chromosome", sim=sim_name, chromosome=chr, loops=int(rows.stop - rows.start)):
+            rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(sim_name, i)))
+            placement = loop_arrays.placements[i] if loop_arrays.placements is not None else None
+            coords = sim_chromosome_coords(loop_arrays.coords[rows], chromosome_length, rng, placement)
+        yield chr, rows, coords
     print(f"Simulation {sim_name} simulation complete", flush=True)
-    return loop_out
 
 
 def split_by_chr(in_loop: pd.DataFrame):
     """Split dataframe by chromosome"""
-    return in_loop.groupby(0, sort=False)
+    return in_loop.groupby(0, sort=False, observed=True)
 
 
-def sim_chromosome(loop_chr_in: pd.DataFrame, chr_rg: pd.DataFrame):
-    """Run simulation on a single chromosome
-    Takes in a dataframe composed of all the rows for a single chromosome
-    and a dataframe of chromosome regions
-    """
-    # Fix: using the module level numpy random generates identical output in parallel processes
-    # See https://github.com/numpy/numpy/issues/12231
-    random_state = np.random.RandomState()
+class LoopArrays:
+    """Loop coordinates split by chromosome once, for every simulation to reuse
+
+    coords is an (n, 4) int64 array of the loop file columns 2, 3, 5 and 6, with the loops of each chromosome in one block
+    (chromosomes in order of appearance, loops in file order within a chromosome). rows has the loop file row of each loop,
+    except in shared copies (the workers never need it, so it isn't sent to each of them).
+
+    placements has the PlacementIndex of each chromosome if some regions are excluded from the simulations (else None).
+
+    After share(), pickling this (e.g. to send it to pool workers) only sends the path of a memory-mapped copy of coords,
+    so every worker reads the same pages instead of getting its own copy."""
+
+    def __init__(self, chromosomes, offsets, chromosome_lengths, coords, rows, placements=None, path=None):
+        self.chromosomes = chromosomes
+        self.offsets = offsets
+        self.chromosome_lengths = chromosome_lengths
+        self.coords = coords
+        self.rows = rows
+        self.placements = placements
+        self.path = path
+
+    @classmethod
+    def from_tables(cls, loop_in: pd.DataFrame, chr_rg: pd.DataFrame, excluded: pd.DataFrame = None):
+        """Split a loop table by chromosome, looking up each chromosome's length in the chromosome regions table
+
+        If an excluded regions table (chromosome, start, end) is passed, simulated loops are kept out of those regions."""
+        return cls.from_chromosome_blocks(split_by_chr(loop_in), chr_rg, excluded)
+
+    @classmethod
+    def from_chromosome_blocks(cls, blocks, chr_rg: pd.DataFrame, excluded: pd.DataFrame = None, directory=None):
+        """Same as from_tables, but for (chromosome, loop table) blocks indexed by loop file row (see common.read_chromosome_blocks)
+
+        If directory is passed, each block's coordinates are written to the shared file there as soon as it is read
+        (the result is the same as share(directory)), so the whole loop file is never held in memory."""
+        region_lengths = dict(zip(chr_rg[0].astype(str), chr_rg[2]))
+        chromosomes, sizes, lengths, rows, coords, max_spans = [], [], [], [], [], []
+        path = os.path.join(directory, SHARED_COORDS_FILENAME) if directory is not None else None
+        with open(path, "wb") if path is not None else contextlib.nullcontext() as coords_out:
+            for chr, loop_chr_in in blocks:
+                if str(chr) not in region_lengths:
+                    raise click.UsageError(f"chromosome {chr} is not in the chromosome regions file")
+                chromosomes.append(str(chr))
+                sizes.append(len(loop_chr_in))
+                lengths.append(int(region_lengths[str(chr)]))
+                coords_chr = loop_chr_in[[1, 2, 4, 5]].to_numpy(dtype=np.int64)
+                if excluded is not None:
+                    spans = coords_chr[:, 2] - coords_chr[:, 0] + coords_chr[:, 1] - coords_chr[:, 0]
+                    max_spans.append(int(spans.max()) if len(spans) else None)
+                if coords_out is not None:
+                    coords_out.write(coords_chr.tobytes())
+                else:
+                    rows.append(loop_chr_in.index.to_numpy(dtype=np.int64))
+                    coords.append(coords_chr)
 
-    chr = loop_chr_in.loc[loop_chr_in.first_valid_index(), 0]  # Get the chromosome number
+        offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        placements = placement_indexes(chromosomes, lengths, excluded) if excluded is not None else None
+        if placements is not None:
+            # Every loop must have somewhere to go when it is placed randomly
+            for chr, max_span, placement in zip(chromosomes, max_spans, placements):
+                if max_span is not None and max_span >= placement.longest_segment():
+                    raise click.UsageError(
+                        f"a loop on chromosome {chr} spans {max_span} bases, "
+                        f"but the longest region of {chr} that is not excluded is {placement.longest_segment()} bases"
+                    )
+        lengths = np.array(lengths, dtype=np.int64)
+        if path is not None:
+            return open_shared_loop_arrays(chromosomes, offsets, lengths, placements, path)
+        rows = np.concatenate(rows) if rows else np.array([], dtype=np.int64)
+        coords = np.concatenate(coords) if coords else np.empty((0, 4), dtype=np.int64)
+        return cls(chromosomes, offsets, lengths, coords, rows, placements)
 
-    a = chr_rg[chr_rg[0] == chr]  # Region num for current chromosome (range of chromosome)
-    chromosome_length = int(a[2])  # ! Need this or pandas does weird things
+    @property
+    def num_loops(self):
+        return len(self.coords)
 
-    # The output df should have the same dimensions as the input df
-    loop_chr_out = pd.DataFrame(np.empty(loop_chr_in.shape), dtype=object)
+    def chromosome_blocks(self):
+        """Iterate over (chromosome, rows of its block, chromosome length)"""
+        for chr, start, end, length in zip(self.chromosomes, self.offsets[:-1], self.offsets[1:], self.chromosome_lengths):
+            yield chr, slice(start, end), int(length)
 
-    # Fill in the first row
-    prev_row_out = loop_chr_out.loc[0] = sim_chromosome_helper(
-        chr=chr,
-        chromosome_length=chromosome_length,
-        loop_resolution=loop_chr_in.loc[loop_chr_in.first_valid_index(), 2] - loop_chr_in.loc[loop_chr_in.first_valid_index(), 1],
-        loop_length=loop_chr_in.loc[loop_chr_in.first_valid_index(), 4] - loop_chr_in.loc[loop_chr_in.first_valid_index(), 1],
-        random_state=random_state,
+    def loop_blocks(self, coords):
+        """Same as analyze.loop_blocks, but for coordinates laid out like coords"""
+        for chr, rows, _ in self.chromosome_blocks():
+            yield chr, np.arange(rows.start, rows.stop), coords[rows, 0], coords[rows, 3]
+
+    def share(self, directory):
+        """Copy of this whose coords are memory-mapped from a file in directory (which must outlive the workers)"""
+        path = os.path.join(directory, SHARED_COORDS_FILENAME)
+        np.ascontiguousarray(self.coords, dtype=np.int64).tofile(path)
+        return open_shared_loop_arrays(self.chromosomes, self.offsets, self.chromosome_lengths, self.placements, path)
+
+    def __reduce__(self):
+        if self.path is None:
+            return super().__reduce__()
+        return open_shared_loop_arrays, (
+            self.chromosomes,
+            self.offsets,
+            self.chromosome_lengths,
+            self.placements,
+            self.path,
+        )
+
+    def to_dataframe(self, coords):
+        """Loop table (in the same layout as a loop file) of coordinates laid out like coords"""
+        chrs = np.repeat(self.chromosomes, np.diff(self.offsets))
+        return pd.DataFrame({0: chrs, 1: coords[:, 0], 2: coords[:, 1], 3: chrs, 4: coords[:, 2], 5: coords[:, 3]})
+
+
+def chromosome_dataframe(chr, coords):
+    """Same as LoopArrays.to_dataframe, but for the (loops, 4) coordinates of a single chromosome"""
+    return pd.DataFrame({0: chr, 1: coords[:, 0], 2: coords[:, 1], 3: chr, 4: coords[:, 2], 5: coords[:, 3]})
+
+
+def open_shared_loop_arrays(chromosomes, offsets, chromosome_lengths, placements, path):
+    coords = (
+        np.memmap(path, dtype=np.int64, mode="r", shape=(offsets[-1], 4)) if offsets[-1] else np.empty((0, 4), dtype=np.int64)
     )
+    return LoopArrays(chromosomes, offsets, chromosome_lengths, coords, None, placements, path)
+
+
+# Number of rows checked at once when extending a chain of loops
+CHAIN_WINDOW = 4096
+
 
-    prev_row_in = loop_chr_in.loc[loop_chr_in.first_valid_index()]
-
-    # Fill in the rest of the rows
-    # Will start at 2nd row
-    for iterations, row_in in enumerate(
-        loop_chr_in.loc[loop_chr_in.first_valid_index() + 1 : loop_chr_in.last_valid_index() + 1].itertuples(index=False)
-    ):
-        dist_to_prev_real_loop = row_in[1] - prev_row_in[1]  # dist
-        loop_length = row_in[4] - row_in[1]  # len_
-        loop_resolution = row_in[5] - row_in[4]  # res
-
-        if (
-            dist_to_prev_real_loop < 10**6
-            and (prev_row_out[2] + dist_to_prev_real_loop) < chromosome_length
-            and (prev_row_out[2] + dist_to_prev_real_loop + loop_length) < chromosome_length
-        ):
-            row_out = [
-                chr,
-                prev_row_out[1] + dist_to_prev_real_loop,
-                prev_row_out[1] + dist_to_prev_real_loop + loop_resolution,
-                chr,
-                prev_row_out[1] + dist_to_prev_real_loop + loop_length,
-                prev_row_out[1] + dist_to_prev_real_loop + loop_length + loop_resolution,
-            ]
+def sim_chromosome_coords(coords_in, chromosome_length, rng, placement=None):
+    """Simulate the loops of a single chromosome on integer arrays
+
+    coords_in is an (n, 4) int64 array of the loop file columns 2, 3, 5 and 6 (start/end of both loop ends).
+    Each loop is placed at the same distance from the previous simulated loop as in the input ("chained")
+    as long as the input loops are < 1Mb apart and the chained loop still fits on the chromosome.
+    Otherwise the loop is placed at a random position on the chromosome.
+
+    With a placement index (see placement.PlacementIndex), loops are only placed (randomly or chained) in allowed regions.
+
+    Returns an (n, 4) int64 array laid out the same way as coords_in.
+    """
+    n = len(coords_in)
+    in_start = coords_in[:, 0]
+    dist_to_prev_real_loop = np.zeros(n, dtype=np.int64)
+    dist_to_prev_real_loop[1:] = np.diff(in_start)
+    loop_length = coords_in[:, 2] - coords_in[:, 0]
+    chained_resolution = coords_in[:, 3] - coords_in[:, 2]
+    placed_resolution = coords_in[:, 1] - coords_in[:, 0]
+
+    # Loops that are too far from the previous real loop are always placed randomly
+    breaks = np.flatnonzero(dist_to_prev_real_loop >= 10**6)
+
+    out_start = np.empty(n, dtype=np.int64)
+    out_resolution = np.empty(n, dtype=np.int64)
+
+    i = 0
+    while i < n:
+        # Place loop i randomly
+        if placement is None:
+            out_start[i] = random_loop_start(chromosome_length, placed_resolution[i], loop_length[i], rng)
         else:
-            row_out = sim_chromosome_helper(
-                chr=chr,
-                chromosome_length=chromosome_length,
-                loop_resolution=row_in[2] - row_in[1],
-                loop_length=row_in[4] - row_in[1],
-                random_state=random_state,
-            )
+            out_start[i] = placement.random_start(placed_resolution[i] + loop_length[i], rng)
+        out_resolution[i] = placed_resolution[i]
+
+        # Chain the following loops onto it until we hit a break or run off the end of the chromosome
+        next_break = np.searchsorted(breaks, i, side="right")
+        stop = breaks[next_break] if next_break < len(breaks) else n
+        anchor_offset = out_start[i] - in_start[i]
+        j = i + 1
+        while j < stop:
+            hi = min(stop, j + CHAIN_WINDOW)
+            prev_end = in_start[j - 1 : hi - 1] + anchor_offset
+            prev_end[1:] += chained_resolution[j : hi - 1]
+            prev_end[0] += out_resolution[j - 1]
+            next_start = prev_end + dist_to_prev_real_loop[j:hi]
+            fits = (next_start < chromosome_length) & (next_start + loop_length[j:hi] < chromosome_length)
+            if placement is not None:
+                fits &= placement.fits(in_start[j:hi] + anchor_offset, loop_length[j:hi] + chained_resolution[j:hi])
+            num_chained = hi - j if fits.all() else int(fits.argmin())
 
-        loop_chr_out.loc[iterations + 1] = row_out
-        prev_row_in, prev_row_out = row_in, row_out
+            out_start[j : j + num_chained] = in_start[j : j + num_chained] + anchor_offset
+            out_resolution[j : j + num_chained] = chained_resolution[j : j + num_chained]
+            j += num_chained
+            if j < hi:
+                break
+        i = j
 
-    return loop_chr_out
+    coords_out = np.empty((n, 4), dtype=np.int64)
+    coords_out[:, 0] = out_start
+    coords_out[:, 1] = out_start + out_resolution
+    coords_out[:, 2] = out_start + loop_length
+    coords_out[:, 3] = out_start + loop_length + out_resolution
+    return coords_out
 
 
-def sim_chromosome_helper(chr, chromosome_length, loop_resolution, loop_length, random_state):
-    end1 = random_state.choice(np.arange((1 + loop_resolution / 2), (chromosome_length - loop_resolution / 2 - loop_length)))
-    end2 = end1 + loop_length
-    return [
-        chr,
-        end1 - loop_resolution / 2,
-        end1 + loop_resolution / 2,
-        chr,
-        end2 - loop_resolution / 2,
-        end2 + loop_resolution / 2,
-    ]
+def random_loop_start(chromosome_length, loop_resolution, loop_length, rng):
+    """Draw a uniformly random start for a loop so that the whole loop fits on the chromosome"""
+    return rng.integers(1, chromosome_length - loop_resolution - loop_length)
@@ -0,0 +1,146 @@
+"""Binary store for simulated loop files
+
+All simulations of a run go into one .npy file of integer coordinates, shaped (simulations, loops, 4)
+with the columns being the start/end of both loop ends (loop file columns 2, 3, 5 and 6).
+Loops are grouped by chromosome in the same order for every simulation, so the chromosomes are kept
+in a small table next to it: the name of each chromosome and the row offset where its block of loops starts.
+A third file flags which simulations have been written, so that an interrupted run can be resumed.
+
+A sharded run (simulate --shard-index/--shard-count) only holds its own block of the simulations,
+so the chromosome table also records the total number of simulations and which shard the store is.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+from . import common
+
+STORE_FILENAME = "sim_hi-c.npy"
+
+
+def store_path(directory):
+    """Path of the binary store in a simulation data directory"""
+    return os.path.join(directory, STORE_FILENAME)
+
+
+def chromosomes_path(path):
+    """Path of the chromosome table that goes with the binary store at path"""
+    return path[: -len(".npy")] + "_chr.npz"
+
+
+def done_path(path):
+    """Path of the completed simulation flags that go with the binary store at path"""
+    return path[: -len(".npy")] + "_done.npy"
+
+
+def is_store(path):
+    """Is path a binary store, or a directory holding one?"""
+    if os.path.isdir(path):
+        path = store_path(path)
+    return path.endswith(".npy") and os.path.isfile(path) and os.path.isfile(chromosomes_path(path))
+
+
+def create_store(path, num_sims, chromosomes, chromosome_sizes, max_coordinate, shard_index=0, shard_count=1, seed=None):
+    """Create an empty store for num_sims simulations whose loops are grouped in blocks of chromosome_sizes rows
+
+    If the run is sharded, the store only has room for the simulations of its shard (see common.shard_sims).
+    The seed of the run is kept (as text, since it can be bigger than an int64) so that 'merge' can tell runs apart."""
+    offsets = np.concatenate([[0], np.cumsum(chromosome_sizes)]).astype(np.int64)
+    np.savez(
+        chromosomes_path(path),
+        names=np.array([str(chr) for chr in chromosomes]),
+        offsets=offsets,
+        num_sims=num_sims,
+        shard_index=shard_index,
+        shard_count=shard_count,
+        seed=str(seed) if seed is not None else "",
+    )
+
+    # int32 is plenty for any real genome and halves the size of the store
+    dtype = np.int32 if max_coordinate < np.iinfo(np.int32).max else np.int64
+    sims = common.shard_sims(num_sims, shard_index, shard_count)
+    np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(len(sims), offsets[-1], 4)).flush()
+    np.lib.format.open_memmap(done_path(path), mode="w+", dtype=bool, shape=(len(sims),)).flush()
+
+
+class SimulationStore:
+    """Memory-mapped view of a binary store (see create_store)
+
+    Simulations are addressed by their number in the whole run, also when the store only holds one shard of it."""
+
+    def __init__(self, path, mode="r"):
+        if os.path.isdir(path):
+            path = store_path(path)
+        self.path = path
+        self.coords = np.load(path, mmap_mode=mode)
+        self.done = np.load(done_path(path), mmap_mode=mode)
+        with np.load(chromosomes_path(path)) as table:
+            self.chromosomes = table["names"]
+            self.offsets = table["offsets"]
+            # Stores written before sharding existed hold every simulation of their run
+            self.num_sims = int(table["num_sims"]) if "num_sims" in table else self.coords.shape[0]
+            self.shard_index = int(table["shard_index"]) if "shard_index" in table else 0
+            self.shard_count = int(table["shard_count"]) if "shard_count" in table else 1
+            self.seed = int(str(table["seed"])) if "seed" in table and str(table["seed"]) else None
+        self.sims = common.shard_sims(self.num_sims, self.shard_index, self.shard_count)
+
+    def __len__(self):
+        return self.coords.shape[0]
+
+    @property
+    def num_loops(self):
+        return self.coords.shape[1]
+
+    def write_rows(self, sim_name, rows, coords):
+        """Store the coordinates of some rows of a simulation (e.g. one chromosome block), without marking it as done
+
+        The store must be opened with mode="r+"."""
+        self.coords[self.slot(sim_name), rows] = coords
+
+    def mark_done(self, sim_name):
+        """Flag a simulation as fully written, once all of its rows are on disk"""
+        self.coords.flush()
+        self.done[self.slot(sim_name)] = True
+        self.done.flush()
+
+    def slot(self, sim_name):
+        """Position of a simulation in the store"""
+        if sim_name not in self.sims:
+            raise IndexError(
+                f"simulation {sim_name} is not in {self.path} (which holds simulations {self.sims.start} to {self.sims.stop - 1})"
+            )
+        return sim_name - self.sims.start
+
+    def sim_sha256(self, sim_name):
+        """Hash of a simulation's content (its chromosome blocks and coordinates), like common.file_sha256 for a loop file"""
+        sha256 = self.layout_hash()
+        sha256.update(np.ascontiguousarray(self.coords[self.slot(sim_name)], dtype=np.int64).tobytes())
+        return sha256.hexdigest()
+
+    def layout_sha256(self):
+        """Hash of the chromosome blocks that every simulation of the store has"""
+        return self.layout_hash().hexdigest()
+
+    def layout_hash(self):
+        sha256 = hashlib.sha256()
+        sha256.update(" ".join(map(str, self.chromosomes)).encode())
+        sha256.update(np.ascontiguousarray(self.offsets, dtype=np.int64).tobytes())
+        return sha256
+
+    def completed_sims(self):
+        """Simulations that have been fully written"""
+        return np.flatnonzero(self.done) + self.sims.start
+
+    def chromosome_blocks(self, sim_name):
+        """Iterate over (chromosome, rows, coordinates) of a simulation without copying the coordinates"""
+        for chr, start, end in zip(self.chromosomes, self.offsets[:-1], self.offsets[1:]):
+            yield chr, slice(start, end), self.coords[self.slot(sim_name), start:end]
+
+    def to_dataframe(self, sim_name):
+        """Export a simulation in the same layout as a text loop file"""
+        chrs = np.repeat(self.chromosomes, np.diff(self.offsets))
+        coords = self.coords[self.slot(sim_name)]
+        return pd.DataFrame({0: chrs, 1: coords[:, 0], 2: coords[:, 1], 3: chrs, 4: coords[:, 2], 5: coords[:, 3]})
@@ -1,10 +1,15 @@
 """Validate loop file used as input"""
 
+import contextlib
+import os
+import pickle
+import tempfile
+
 import click
 import numpy as np
 import pandas as pd
 
-from . import common
+from . import common, metrics
 
 
 @click.command()
@@ -18,7 +23,17 @@ from . import common
     type=int,
     help="Flag loop ends that are sized >= this param",
 )
-def validate(loop_in_file, loop_out_file, chromosome_region_file, flag_end_size):
+@click.option(
+    "--report-file",
+    type=click.Path(exists=False, file_okay=True, dir_okay=False, writable=True),
+    help="if passed, will output the row number and failed check of every warning to this file",
+)
+@click.option(
+    "--streaming",
+    is_flag=True,
+    help="sort and validate one chromosome at a time, for loop files too big to load at once",
+)
+def validate(loop_in_file, loop_out_file, chromosome_region_file, flag_end_size, report_file, streaming):
     """Validate input file and output a validated version
 
     Check that each row satisfies the following criteria:\n
@@ -29,6 +44,12 @@ def validate(loop_in_file, loop_out_file, chromosome_region_file, flag_end_size)
      - Chromosome of start region is the same as chromosome of end region -> (print warning and remove affected row)\n
      - Start region size and end region size are less than value passed to --flag-end-size (default 100K) -> (print warning and remove affected row)\n
 
+    A count of the rows that fail each check is printed. Use --report-file to get the individual row numbers.
+
+    With --streaming, the loops are first split into one temporary file per chromosome (next to LOOP_OUT_FILE), and each
+    chromosome is then sorted, validated and written out in turn, so only one chromosome is in memory at a time.
+    The output is the same as without it.
+
     NOTE: the validated file (LOOP_OUT_FILE) may be unchanged from the original."""
 
     # Print params
@@ -36,29 +57,114 @@ def validate(loop_in_file, loop_out_file, chromosome_region_file, flag_end_size)
     print(f"Output loop file: {loop_out_file}")
     print(f"Chromosome regions file: {chromosome_region_file}")
     print(f"Flagging loop ends that are >= {flag_end_size:e}")
+    if report_file:
+        print(f"Report file: {report_file}")
     print(f"Delimiter for output: '{common.delimiter}'")
 
-    # Read in loop data
-    loop_in = pd.read_table(loop_in_file, header=None, delimiter=common.detect_delimiter(loop_in_file))
-
     # Read in chromosome regions
-    chr_rg = pd.read_table(chromosome_region_file, header=None, delimiter=common.detect_delimiter(chromosome_region_file))
+    chr_rg = common.read_table(chromosome_region_file, "region")
+
+    if streaming:
+        validate_streaming(loop_in_file, loop_out_file, chr_rg, flag_end_size, report_file)
+        print(f"Validated data outputted to file {loop_out_file}")
+        return
+
+    # Read in loop data
+    loop_in = common.read_table(loop_in_file, "loop")
 
     # Sort loop_in
-    # Note: sorting by: col 0, 1, then 2
-    loop_in[0] = pd.Categorical(loop_in[0], chr_rg[0])
-    loop_in = loop_in.sort_values(by=[0, 1, 2], ignore_index=True)
-    loop_in[0] = loop_in[0].astype("object")
+    loop_in = sort_loop_in(loop_in, chr_rg)
 
     # Validate loop data
-    loop_out = validate_loop_in(loop_in, flag_end_size)
+    with metrics.timer("validate", loops=len(loop_in)):
+        loop_out = validate_loop_in(loop_in, flag_end_size, report_file)
 
     # Output data
-    loop_out.to_csv(loop_out_file, header=None, index=None, sep=common.delimiter)
+    with metrics.timer("write", file=loop_out_file):
+        loop_out.to_csv(loop_out_file, header=None, index=None, sep=common.delimiter)
     print(f"Validated data outputted to file {loop_out_file}")
 
 
-def validate_loop_in(loop_in, flag_end_size):
+def sort_loop_in(loop_in, chr_rg):
+    """Sort loops by chromosome (in the order of the chromosome regions file), then by columns 2 and 3
+
+    Loops on chromosomes that are not in the chromosome regions file get a missing chromosome and go last."""
+    loop_in[0] = pd.Categorical(loop_in[0], chr_rg[0].astype(str))
+    loop_in = loop_in.sort_values(by=[0, 1, 2], ignore_index=True)
+    loop_in[0] = loop_in[0].astype("object")
+    return loop_in
+
+
+def validate_streaming(loop_in_file, loop_out_file, chr_rg, flag_end_size, report_file=None):
+    """Same as sorting the whole loop file and validating it with validate_loop_in, but one chromosome at a time"""
+    print("Validating loop data one chromosome at a time")
+    chromosomes = list(chr_rg[0].astype(str))
+    num_failed = {}
+    num_reported = num_rows = 0
+    with contextlib.ExitStack() as stack:
+        directory = stack.enter_context(tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(loop_out_file))))
+        loop_out = stack.enter_context(open(loop_out_file, "w"))
+        report_out = stack.enter_context(open(report_file, "w")) if report_file else None
+
+        # Chromosomes that aren't in the chromosome regions file all go last, so they share one file
+        with metrics.timer("split", file=loop_in_file):
+            chromosome_files = split_chromosomes(loop_in_file, set(chromosomes), directory)
+        for chr in [*chromosomes, None]:
+            if chr not in chromosome_files:
+                continue
+            loop_chr = sort_loop_in(read_chromosome_file(chromosome_files[chr]), chr_rg)
+            os.remove(chromosome_files[chr])
+
+            with metrics.timer("validate", loops=len(loop_chr), chromosome=chr):
+                loop_chr_validated, checks = check_loop_in(loop_chr, flag_end_size)
+            for _, _, failed, warning in checks:
+                num_failed[warning] = num_failed.get(warning, 0) + failed.sum()
+            if report_out:
+                report = report_rows(checks, row_offset=num_rows)
+                report.to_csv(report_out, header=None, index=None, sep=common.delimiter)
+                num_reported += len(report)
+            num_rows += len(loop_chr)
+
+            with metrics.timer("write", file=loop_out_file, chromosome=chr):
+                loop_chr_validated.to_csv(loop_out, header=None, index=None, sep=common.delimiter)
+
+    print_warnings(num_failed)
+    if report_file:
+        print(f"Outputted row numbers of {num_reported} warnings to {report_file}")
+    print("Validation complete")
+
+
+def split_chromosomes(loop_in_file, chromosomes, directory):
+    """Split a loop file into one file of pickled chunks per chromosome (None for the chromosomes not in chromosomes)
+
+    The rows of each chromosome keep their order in the loop file. Returns {chromosome: file}."""
+    chromosome_files = {}
+    with contextlib.ExitStack() as stack:
+        outs = {}
+        for chunk in common.parse_table(loop_in_file, "loop", chunksize=common.STREAM_CHUNK_ROWS):
+            chrs = chunk[0].astype(str).where(chunk[0].astype(str).isin(chromosomes) & chunk[0].notna(), "")
+            for chr, loop_chr in chunk.groupby(chrs.to_numpy(), sort=False):
+                key = chr or None
+                if key not in outs:
+                    chromosome_files[key] = os.path.join(directory, f"chromosome_{len(chromosome_files)}.pkl")
+                    outs[key] = stack.enter_context(open(chromosome_files[key], "wb"))
+                pickle.dump(loop_chr, outs[key], protocol=pickle.HIGHEST_PROTOCOL)
+    return chromosome_files
+
+
+def read_chromosome_file(filename):
+    """Loops of one chromosome from split_chromosomes"""
+    chunks = []
+    with open(filename, "rb") as f:
+        while True:
+            try:
+                chunks.append(pickle.load(f))
+            except EOFError:
+                break
+    return pd.concat(chunks, ignore_index=True)
+
+
+def validate_loop_in(loop_in, flag_end_size, report_file=None):
     """Validate input loop with the following criteria (per row):
     1) Check if start size and end size are the same (if V6-V5 = V3-V2), if not -> issue warning
     2) Check that V3 > V2 and V6 > V5, if not -> issue warning
@@ -66,60 +172,80 @@ def validate_loop_in(loop_in, flag_end_size):
     4) Check that the position of end > position of start (only if not caught already on other errors), if not -> issue warning & swap start with end
     5) Check if long-distance (loop that starts and ends in different chromosomes), if so -> remove affected row & issue warning
     6) Check that no loop distance is >100K, if so -> remove affected row & issue warning
+
+    Every check runs on whole columns at once. One warning with the number of affected rows is printed per check;
+    pass report_file to also get the number of every affected row (counting from 1) and the check it failed.
     """
     print("Validating loop data")
-    loop_in_validated = loop_in.apply(validate_row, axis="columns", args=(flag_end_size,)).dropna()
+    loop_in_validated, checks = check_loop_in(loop_in, flag_end_size)
+    print_warnings({warning: failed.sum() for _, _, failed, warning in checks})
+
+    if report_file:
+        report = report_rows(checks)
+        report.to_csv(report_file, header=None, index=None, sep=common.delimiter)
+        print(f"Outputted row numbers of {len(report)} warnings to {report_file}")
+
     print("Validation complete")
     return loop_in_validated
 
 
-def validate_row(row, flag_end_size):
-    row[1], row[2], row[4], row[5] = int(row[1]), int(row[2]), int(row[4]), int(row[5])
-    row_num = row.name + 1  # Count from 1 for ease of use
-    error_found = False
-    first_end_len = row[2] - row[1]
-    second_end_len = row[5] - row[4]
-    # 1
-    if first_end_len != second_end_len:
-        print(f"WARNING: sizes of first and second end of loop differ ({first_end_len} != {second_end_len}) on row {row_num}")
-        error_found = True
-    # 2
-    if row[1] >= row[2]:
-        print(f"WARNING: first end of loop has start >= end ({row[2]} >= {row[1]}) on row {row_num}")
-        error_found = True
-    # 2
-    if row[4] >= row[5]:
-        print(f"WARNING: second end of loop has start >= end ({row[4]} >= {row[5]}) on row {row_num}")
-        error_found = True
-    # 3
-    if row[2] >= row[4]:
-        print(f"WARNING: first and second end of loop overlap ({row[2]} >= {row[4]}) on row {row_num}")
-        error_found = True
-    if not error_found:
-        # 4
-        remove_row = False
-        if row[5] < row[1]:
-            print(f"WARNING: Second end of loop comes before first end [{row[1:3]} > {row[4:]}] on row {row_num}")
-            print(f"swapping first and second ends...")
-            old_start = row[:3]
-            old_end = row[3:]
-            row[:3] = old_end
-            row[3:] = old_start
-        # 5
-        if row[0] != row[3]:
-            print(f"WARNING: long-distance loop detected ({row[0]} != {row[3]}) on row {row_num}")
-            print(f"removing row...")
-            remove_row = True
-        # 6
-        if first_end_len >= flag_end_size:
-            print(f"WARNING: first end of loop exceeds {flag_end_size:e} ({first_end_len} >= {flag_end_size}) on row {row_num}")
-            print(f"removing row...")
-            remove_row = True
-        # 6
-        if second_end_len >= flag_end_size:
-            print(f"WARNING: second end of loop exceeds {flag_end_size:e} ({second_end_len} >= {flag_end_size}) on row {row_num}")
-            print(f"removing row...")
-            remove_row = True
-        if remove_row:
-            row[0] = np.NaN
-    return row
+def check_loop_in(loop_in, flag_end_size):
+    """Run the checks of validate_loop_in without printing anything
+
+    Returns the validated loops and (check number, check name, rows that failed it, warning) for each check"""
+    loop_in = loop_in.copy()
+    for col in (1, 2, 4, 5):
+        loop_in[col] = loop_in[col].astype(np.int64)
+
+    first_end_len = loop_in[2] - loop_in[1]
+    second_end_len = loop_in[5] - loop_in[4]
+
+    # Checks 1-3 only warn, and rows that fail them are not checked any further
+    sizes_differ = first_end_len != second_end_len
+    first_end_reversed = loop_in[1] >= loop_in[2]
+    second_end_reversed = loop_in[4] >= loop_in[5]
+    ends_overlap = loop_in[2] >= loop_in[4]
+    no_error = ~(sizes_differ | first_end_reversed | second_end_reversed | ends_overlap)
+
+    # 4
+    ends_swapped = no_error & (loop_in[5] < loop_in[1])
+    for start_col, end_col in ((0, 3), (1, 4), (2, 5)):
+        loop_in[start_col], loop_in[end_col] = (
+            loop_in[start_col].where(~ends_swapped, loop_in[end_col]),
+            loop_in[end_col].where(~ends_swapped, loop_in[start_col]),
+        )
+
+    # 5 & 6
+    long_distance = no_error & (loop_in[0] != loop_in[3])
+    first_end_too_big = no_error & (first_end_len >= flag_end_size)
+    second_end_too_big = no_error & (second_end_len >= flag_end_size)
+
+    checks = [
+        (1, "sizes_differ", sizes_differ, "sizes of first and second end of loop differ"),
+        (2, "first_end_reversed", first_end_reversed, "first end of loop has start >= end"),
+        (2, "second_end_reversed", second_end_reversed, "second end of loop has start >= end"),
+        (3, "ends_overlap", ends_overlap, "first and second end of loop overlap"),
+        (4, "ends_swapped", ends_swapped, "second end of loop comes before first end (swapped first and second ends)"),
+        (5, "long_distance", long_distance, "long-distance loop detected (removed row)"),
+        (6, "first_end_too_big", first_end_too_big, f"first end of loop exceeds {flag_end_size:e} (removed row)"),
+        (6, "second_end_too_big", second_end_too_big, f"second end of loop exceeds {flag_end_size:e} (removed row)"),
+    ]
+    loop_in_validated = loop_in.loc[~(long_distance | first_end_too_big | second_end_too_big)].dropna()
+    return loop_in_validated, checks
+
+
+def print_warnings(num_failed):
+    """Print one warning per check that rows failed, given {warning: number of rows that failed the check}"""
+    for warning, count in num_failed.items():
+        if count:
+            print(f"WARNING: {warning} on {count} rows")
+
+
+def report_rows(checks, row_offset=0):
+    """Report of the rows that failed each check (see check_loop_in), sorted by row number (counting from row_offset + 1)"""
+    return pd.concat(
+        [
+            pd.DataFrame({0: np.flatnonzero(failed) + row_offset + 1, 1: check, 2: name})  # Count from 1 for ease of use
+            for check, name, failed, _ in checks
+        ]
+    ).sort_values(by=[0, 1], kind="stable")
@@ -2,10 +2,8 @@
 
 import click
 import pandas as pd
-import seaborn as sb
-from scipy.stats import norm, normaltest
 
-from . import common
+from . import common, metrics
 
 
 @click.command()
@@ -29,15 +27,21 @@ def visualize(distribution_file, plot_file, other):
     Optionally, can pass a data point for statistical comparison with --other flag
     """
 
+    # seaborn (with matplotlib) and scipy take longer to import than most commands take to run, so only load them here
+    import seaborn as sb
+    from scipy.stats import norm, normaltest
+
     # Print params
     print(f"Obtaining overlapping ratios from: {distribution_file}.")
 
     # Get data
-    dist = pd.read_table(
-        distribution_file,
-        header=None,
-        delimiter=common.detect_delimiter(distribution_file),
-    )
+    with metrics.timer("parse", file=distribution_file, kind="distribution"):
+        dist = pd.read_table(
+            distribution_file,
+            header=None,
+            delimiter=common.detect_delimiter(distribution_file),
+            compression=common.detect_compression(distribution_file),
+        )
 
     # Create distribution plot
     ax = sb.histplot(data=dist[0], label="Simulated", kde=True)
@@ -55,7 +59,8 @@ def visualize(distribution_file, plot_file, other):
     sb.move_legend(ax, "upper left", bbox_to_anchor=(1, 1))
 
     # Export to jpg
-    ax.get_figure().savefig(plot_file, bbox_inches="tight", dpi=300)
+    with metrics.timer("write", file=plot_file):
+        ax.get_figure().savefig(plot_file, bbox_inches="tight", dpi=300)
     print(f"Exported plot to {plot_file}")
 
     # Summary stats
@@ -71,6 +76,8 @@ def visualize(distribution_file, plot_file, other):
         print("\nCalculating p-value based on empirical distribution:")
         num_larger = len(dist.loc[dist[0] > other])
         print(f"p-value: {num_larger / len(dist):.20f}")
+        lower, upper = common.wilson_interval(num_larger, len(dist))
+        print(f"95% confidence interval: [{lower:.20f}, {upper:.20f}]")
 
         print("\nCalculating p-value based on normal distribution:")
         z_stat = (other - dist[0].mean()) / dist[0].std()